@@ -0,0 +1,315 @@
+import bisect
+import heapq
+import logging
+import threading
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import crud
+from database import SessionLocal
+from models import Book, Character, Photo, Review, ReviewRollup, UserDocument, Video
+from models import character_book, character_photo, character_video
+
+logger = logging.getLogger(__name__)
+
+# Entry kinds; the media kinds match Review.media_type
+KINDS = ("photo", "video", "book", "document", "character", "author")
+# Queried prefixes up to this length keep a ranked top list per kind, updated in
+# place on changes; longer prefixes match few entries and are scanned directly
+MAX_TOP_PREFIX = 12
+TOP_K = 50  # the largest limit the endpoint accepts
+TOP_MAX_PREFIXES = 4096
+
+def normalize(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+def _keys(label: str) -> List[str]:
+    """Index keys for a label: the label from each word on, so a prefix of any word matches"""
+    words = normalize(label).split(" ")
+    return [" ".join(words[i:]) for i in range(len(words)) if words[i]]
+
+class PrefixIndex:
+    """Sorted in-memory (key, kind, ref) entries answering prefix queries with two bisections"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries: List[Tuple[str, str, object]] = []
+        self._labels = {}
+        self._popularity = Counter()
+        self._author_books = Counter()
+        self._book_authors = {}
+        # (prefix, kind) -> best rank tuples, see _rank(); fewer than TOP_K means all matches
+        self._top = {}
+        self._pending = None
+        self.ready = False
+
+    # Mutations
+    def upsert(self, kind: str, ref, label: Optional[str]) -> None:
+        with self._lock:
+            if self._record("upsert", kind, ref, label):
+                return
+            before = self._state(kind, ref)
+            self._remove(kind, ref)
+            if label:
+                self._labels[(kind, ref)] = label
+                for key in _keys(label):
+                    bisect.insort(self._entries, (key, kind, ref))
+            self._update_top(kind, ref, before)
+
+    def remove(self, kind: str, ref) -> None:
+        with self._lock:
+            if self._record("remove", kind, ref):
+                return
+            before = self._state(kind, ref)
+            self._remove(kind, ref)
+            self._popularity.pop((kind, ref), None)
+            self._update_top(kind, ref, before)
+
+    def bump(self, kind: str, ref, delta: int) -> None:
+        with self._lock:
+            if self._record("bump", kind, ref, delta):
+                return
+            before = self._state(kind, ref)
+            self._popularity[(kind, ref)] += delta
+            self._update_top(kind, ref, before)
+
+    def set_book_author(self, book_id: int, author: Optional[str]) -> None:
+        """Authors are indexed once however many books they wrote, ranked by book count"""
+        with self._lock:
+            if self._record("set_book_author", book_id, author):
+                return
+            old_author = self._book_authors.pop(book_id, None)
+            if author:
+                self._book_authors[book_id] = author
+            if old_author == author:
+                return
+            if old_author:
+                self._count_author(old_author, -1)
+            if author:
+                self._count_author(author, 1)
+
+    def _count_author(self, author: str, delta: int) -> None:
+        ref = normalize(author)
+        before = self._state("author", ref)
+        self._author_books[ref] += delta
+        count = self._author_books[ref]
+        if count <= 0:
+            del self._author_books[ref]
+            self._remove("author", ref)
+            self._popularity.pop(("author", ref), None)
+        else:
+            if ("author", ref) not in self._labels:
+                self._labels[("author", ref)] = author
+                for key in _keys(author):
+                    bisect.insort(self._entries, (key, "author", ref))
+            self._popularity[("author", ref)] = count
+        self._update_top("author", ref, before)
+
+    def _remove(self, kind: str, ref) -> None:
+        label = self._labels.pop((kind, ref), None)
+        if label is None:
+            return
+        for key in _keys(label):
+            position = bisect.bisect_left(self._entries, (key, kind, ref))
+            if position < len(self._entries) and self._entries[position] == (key, kind, ref):
+                del self._entries[position]
+
+    # Top lists
+    def _rank(self, kind: str, ref) -> tuple:
+        """Sort key: most popular first, authors after titles with the same count, then by label"""
+        return (-self._popularity[(kind, ref)], kind == "author", self._labels[(kind, ref)], ref)
+
+    def _state(self, kind: str, ref) -> Tuple[Optional[str], Optional[tuple]]:
+        label = self._labels.get((kind, ref))
+        return label, self._rank(kind, ref) if label else None
+
+    @staticmethod
+    def _prefixes(label: Optional[str]) -> set:
+        if not label:
+            return set()
+        return {key[:n] for key in _keys(label) for n in range(1, min(len(key), MAX_TOP_PREFIX) + 1)}
+
+    def _update_top(self, kind: str, ref, before: Tuple[Optional[str], Optional[tuple]]) -> None:
+        """Move one entry within the top lists of its prefixes after a change"""
+        old_label, old_rank = before
+        label, rank = self._state(kind, ref)
+        if not self._top or (old_label, old_rank) == (label, rank):
+            return
+        old_prefixes, new_prefixes = self._prefixes(old_label), self._prefixes(label)
+        for prefix in old_prefixes | new_prefixes:
+            top = self._top.get((prefix, kind))
+            if top is None:
+                continue
+            full = len(top) == TOP_K
+            was_in = False
+            if prefix in old_prefixes:
+                position = bisect.bisect_left(top, old_rank)
+                if position < len(top) and top[position] == old_rank:
+                    del top[position]
+                    was_in = True
+            if prefix in new_prefixes and not (was_in and full and rank > old_rank):
+                if len(top) < TOP_K:
+                    bisect.insort(top, rank)
+                elif rank < top[-1]:
+                    bisect.insort(top, rank)
+                    top.pop()
+            elif was_in and full:
+                # Entries past the list may now rank higher; rebuilt on the next query
+                del self._top[(prefix, kind)]
+
+    def _build_top(self, prefix: str) -> None:
+        start = bisect.bisect_left(self._entries, (prefix,))
+        end = bisect.bisect_left(self._entries, (prefix + "\uffff",))
+        matches = {kind: set() for kind in KINDS}
+        for _, kind, ref in self._entries[start:end]:
+            matches[kind].add(ref)
+        if len(self._top) + len(KINDS) > TOP_MAX_PREFIXES * len(KINDS):
+            self._top.clear()
+        for kind, refs in matches.items():
+            self._top[(prefix, kind)] = heapq.nsmallest(TOP_K, (self._rank(kind, ref) for ref in refs))
+
+    def _record(self, *change) -> bool:
+        # While a rebuild runs, changes are queued and replayed on the new data
+        if self._pending is None:
+            return False
+        self._pending.append(change)
+        return True
+
+    # Queries
+    def complete(self, prefix: str, kinds: Iterable[str] = KINDS, limit: int = 10) -> List[dict]:
+        """Top matches by popularity among entries with a key starting with prefix"""
+        prefix = normalize(prefix)
+        kinds = frozenset(kinds)
+        limit = min(limit, TOP_K)
+        with self._lock:
+            if len(prefix) <= MAX_TOP_PREFIX:
+                if any((prefix, kind) not in self._top for kind in kinds):
+                    self._build_top(prefix)
+                candidates = [(rank, kind) for kind in kinds for rank in self._top[(prefix, kind)][:limit]]
+            else:
+                start = bisect.bisect_left(self._entries, (prefix,))
+                end = bisect.bisect_left(self._entries, (prefix + "\uffff",))
+                matches = {(kind, ref) for _, kind, ref in self._entries[start:end] if kind in kinds}
+                candidates = [(self._rank(kind, ref), kind) for kind, ref in matches]
+            return [
+                {
+                    "type": kind,
+                    "id": rank[3] if kind != "author" else None,
+                    "label": rank[2],
+                    "popularity": -rank[0],
+                }
+                for rank, kind in heapq.nsmallest(limit, candidates)
+            ]
+
+    # Bulk load
+    def rebuild(self, db: Session) -> None:
+        """Reload everything from the database; changes made meanwhile are replayed afterwards"""
+        with self._lock:
+            self._pending = []
+        try:
+            fresh = PrefixIndex()
+            fresh._pending = None
+            for kind, model, column in (("photo", Photo, Photo.title), ("video", Video, Video.title),
+                                        ("book", Book, Book.title), ("document", UserDocument, UserDocument.title),
+                                        ("character", Character, Character.name)):
+                for ref, label in db.query(model.id, column).yield_per(1000):
+                    if label:
+                        fresh._labels[(kind, ref)] = label
+                        fresh._entries.extend((key, kind, ref) for key in _keys(label))
+            for book_id, author in db.query(Book.id, Book.author).yield_per(1000):
+                if author:
+                    ref = normalize(author)
+                    fresh._book_authors[book_id] = author
+                    fresh._author_books[ref] += 1
+                    fresh._labels.setdefault(("author", ref), author)
+            for ref, count in fresh._author_books.items():
+                fresh._entries.extend((key, "author", ref) for key in _keys(fresh._labels[("author", ref)]))
+                fresh._popularity[("author", ref)] = count
+            fresh._entries.sort()
+
+            # Media popularity is the review count, characters rank by linked media
+            for media_type, media_id, count in db.query(
+                ReviewRollup.media_type, ReviewRollup.media_id, func.sum(ReviewRollup.review_count)
+            ).group_by(ReviewRollup.media_type, ReviewRollup.media_id):
+                fresh._popularity[(media_type, media_id)] = int(count)
+            for table in (character_photo, character_video, character_book):
+                for character_id, count in db.query(table.c.character_id, func.count()).group_by(table.c.character_id):
+                    fresh._popularity[("character", character_id)] += count
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending = self._pending
+            self._pending = None
+            self._entries = fresh._entries
+            self._labels = fresh._labels
+            self._popularity = fresh._popularity
+            self._author_books = fresh._author_books
+            self._book_authors = fresh._book_authors
+            self._top.clear()
+            for method, *args in pending:
+                getattr(self, method)(*args)
+            self.ready = True
+
+index = PrefixIndex()
+
+# Keep the index in step with committed writes
+def _media_listener(kind: str, label_attr: str):
+    def listener(db: Session, event: str, obj) -> None:
+        if event == "delete":
+            index.remove(kind, obj.id)
+        elif event in ("create", "update"):
+            index.upsert(kind, obj.id, getattr(obj, label_attr))
+        elif event == "link":
+            index.bump(kind, obj[0], 1)
+    return listener
+
+for _crud_obj, _kind in ((crud.photo, "photo"), (crud.video, "video"), (crud.user_document, "document")):
+    _crud_obj.add_listener(_media_listener(_kind, "title"))
+crud.character.add_listener(_media_listener("character", "name"))
+
+def _book_listener(db: Session, event: str, book: Book) -> None:
+    if event == "delete":
+        index.remove("book", book.id)
+        index.set_book_author(book.id, None)
+    else:
+        index.upsert("book", book.id, book.title)
+        index.set_book_author(book.id, book.author)
+
+crud.book.add_listener(_book_listener)
+
+def _review_listener(db: Session, event: str, review: Review) -> None:
+    if event == "create":
+        index.bump(review.media_type, review.media_id, 1)
+    elif event == "delete":
+        index.bump(review.media_type, review.media_id, -1)
+
+crud.review.add_listener(_review_listener)
+
+def complete_from_db(db: Session, prefix: str, kinds: Iterable[str], limit: int = 10) -> List[dict]:
+    """Title-prefix lookup used while the index is still being built at startup"""
+    results = []
+    columns = {"photo": Photo.title, "video": Video.title, "book": Book.title,
+               "document": UserDocument.title, "character": Character.name}
+    for kind in kinds:
+        if kind == "author":
+            for (author,) in db.query(Book.author).filter(Book.author.ilike(f"{prefix}%")).distinct().limit(limit):
+                results.append({"type": kind, "id": None, "label": author, "popularity": 0})
+            continue
+        column = columns[kind]
+        for ref, label in db.query(column.class_.id, column).filter(column.ilike(f"{prefix}%")).limit(limit):
+            results.append({"type": kind, "id": ref, "label": label, "popularity": 0})
+    return results[:limit]
+
+def rebuild_index() -> None:
+    db = SessionLocal()
+    try:
+        index.rebuild(db)
+        logger.info("Autocomplete index ready")
+    finally:
+        db.close()
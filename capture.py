@@ -0,0 +1,165 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from queue import SimpleQueue
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Capture is off unless CAPTURE_FILE is set (e.g. captures/requests.jsonl).
+# Sampled requests are appended one JSON object per line and replayed with
+# `python replay.py`.
+CAPTURE_FILE = os.environ.get("CAPTURE_FILE")
+SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", "1"))
+# The file is rotated to .1, .2, ... once it reaches MAX_BYTES
+MAX_BYTES = int(os.environ.get("CAPTURE_MAX_BYTES", str(64 * 1024 * 1024)))
+BACKUP_COUNT = 5
+# Longer request bodies are cut and the record is marked truncated (not replayed)
+MAX_BODY_BYTES = 64 * 1024
+# Paths never captured (admin requests carry the admin token)
+SKIPPED_PREFIXES = ("/api/v1/admin/",)
+
+class CaptureWriter:
+    """Appends records from a background thread so requests never wait on the file"""
+
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES, backup_count: int = BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue: SimpleQueue = SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    # Lifecycle
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-capture", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        """Write what is queued and stop the writer thread"""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def put(self, record: dict) -> None:
+        self._queue.put(record)
+
+    # Writer thread
+    def _run(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = open(self.path, "a", encoding="utf-8")
+        try:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    return
+                lines = [record]
+                # Write whatever else is already waiting in one go
+                while not self._queue.empty():
+                    record = self._queue.get()
+                    if record is None:
+                        self._queue.put(None)
+                        break
+                    lines.append(record)
+                try:
+                    f.write("".join(json.dumps(line, separators=(",", ":")) + "\n" for line in lines))
+                    f.flush()
+                    if f.tell() >= self.max_bytes:
+                        f.close()
+                        self._rotate()
+                        f = open(self.path, "a", encoding="utf-8")
+                except OSError:
+                    logger.exception("Could not write %d captured requests", len(lines))
+        finally:
+            f.close()
+
+    def _rotate(self) -> None:
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+class CaptureMiddleware:
+    """ASGI middleware recording sampled requests with their status and timing
+
+    Sub-requests of a batch are skipped: replaying the batch runs them again.
+    Only the request is kept (method, path, query, content type, body) plus the
+    response status, a SHA-256 of the response body and the duration, which is
+    what replay.py needs to send it again and compare the outcome.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._sequence = 0
+
+    async def __call__(self, scope, receive, send):
+        if (
+            writer is None
+            or scope["type"] != "http"
+            or scope.get("batch_subrequest")
+            or scope["path"].startswith(SKIPPED_PREFIXES)
+            or (SAMPLE_RATE < 1 and random.random() >= SAMPLE_RATE)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        self._sequence += 1
+        record = {
+            "seq": self._sequence,
+            "ts": time.time(),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope.get("query_string", b"").decode("latin-1"),
+            "content_type": dict(scope.get("headers", [])).get(b"content-type", b"").decode("latin-1"),
+        }
+        body = bytearray()
+        truncated = False
+        response_hash = hashlib.sha256()
+
+        async def receive_wrapper():
+            nonlocal truncated
+            message = await receive()
+            if message["type"] == "http.request" and not truncated:
+                chunk = message.get("body", b"")
+                if len(body) + len(chunk) > MAX_BODY_BYTES:
+                    truncated = True
+                else:
+                    body.extend(chunk)
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response_hash.update(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            record.setdefault("status", 500)
+            record["response_sha256"] = response_hash.hexdigest()
+            if truncated:
+                record["body_truncated"] = True
+            elif body:
+                try:
+                    record["body"] = body.decode("utf-8")
+                except UnicodeDecodeError:
+                    record["body_base64"] = base64.b64encode(bytes(body)).decode()
+            writer.put(record)
+
+writer = CaptureWriter(CAPTURE_FILE) if CAPTURE_FILE else None
@@ -0,0 +1,406 @@
+import logging
+import os
+import posixpath
+import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+from pypdf import PdfReader
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import crud
+import storage
+import writer
+from database import SessionLocal
+from models import Book, ContentChunk, ContentSource, UserDocument
+
+logger = logging.getLogger(__name__)
+
+# Media types whose files are indexed
+CONTENT_MODELS = {"book": Book, "document": UserDocument}
+WORKERS = 2
+# Extracted text is split into chunks of about this many characters
+CHUNK_CHARS = 2000
+# Chunks written per transaction; bounds the text held in memory per file
+INSERT_BATCH_SIZE = 200
+# Plain text files have no pages, every TEXT_PAGE_LINES lines count as one
+TEXT_PAGE_LINES = 60
+TEXT_EXTENSIONS = {".txt", ".md", ".rst", ".csv", ".html", ".htm"}
+
+# External-content FTS5 index over content_chunks, kept in sync by triggers
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS content_fts USING fts5(
+        text, content='content_chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS content_chunks_ai AFTER INSERT ON content_chunks BEGIN
+        INSERT INTO content_fts (rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS content_chunks_ad AFTER DELETE ON content_chunks BEGIN
+        INSERT INTO content_fts (content_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END""",
+]
+
+def create_fts_index(engine) -> None:
+    with engine.begin() as conn:
+        for statement in FTS_DDL:
+            conn.execute(text(statement))
+
+# Extraction: each format is streamed as (page number, text) pairs
+class _HTMLText(HTMLParser):
+    SKIP = {"script", "style", "head"}
+    BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts: List[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+def html_text(markup: str) -> str:
+    parser = _HTMLText()
+    parser.feed(markup)
+    parser.close()
+    return "".join(parser.parts)
+
+def _pdf_pages(path: str) -> Iterator[Tuple[int, str]]:
+    # pypdf parses pages lazily, only the current page is held in memory
+    reader = PdfReader(path)
+    for number, page in enumerate(reader.pages, 1):
+        yield number, page.extract_text() or ""
+
+_OPF = "{http://www.idpf.org/2007/opf}"
+_CONTAINER = "{urn:oasis:names:tc:opendocument:xmlns:container}"
+
+def _epub_pages(path: str) -> Iterator[Tuple[int, str]]:
+    """One page per spine document (chapter), in reading order"""
+    with zipfile.ZipFile(path) as archive:
+        container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+        opf_path = container.find(f".//{_CONTAINER}rootfile").get("full-path")
+        package = ElementTree.fromstring(archive.read(opf_path))
+        manifest = {item.get("id"): item.get("href") for item in package.iter(f"{_OPF}item")}
+        base = posixpath.dirname(opf_path)
+        for number, itemref in enumerate(package.iter(f"{_OPF}itemref"), 1):
+            href = manifest.get(itemref.get("idref"))
+            if href is None:
+                continue
+            name = posixpath.normpath(posixpath.join(base, unquote(href)))
+            yield number, html_text(archive.read(name).decode("utf-8", "replace"))
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def _docx_pages(path: str) -> Iterator[Tuple[int, str]]:
+    """Pages split at explicit and last-rendered page breaks; the XML is parsed incrementally"""
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as document:
+        number, parts = 1, []
+        for event, element in ElementTree.iterparse(document, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                is_break = tag == f"{_W}lastRenderedPageBreak" or (
+                    tag == f"{_W}br" and element.get(f"{_W}type") == "page"
+                )
+                if is_break and parts:
+                    yield number, "".join(parts)
+                    number, parts = number + 1, []
+            elif tag == f"{_W}t":
+                parts.append(element.text or "")
+            elif tag == f"{_W}tab":
+                parts.append("\t")
+            elif tag == f"{_W}p":
+                parts.append("\n")
+                element.clear()
+        if parts:
+            yield number, "".join(parts)
+
+def _text_pages(path: str) -> Iterator[Tuple[int, str]]:
+    is_html = os.path.splitext(path)[1].lower() in (".html", ".htm")
+    with open(path, encoding="utf-8", errors="replace") as f:
+        number, lines = 1, []
+        for line in f:
+            lines.append(line)
+            if len(lines) == TEXT_PAGE_LINES:
+                yield number, html_text("".join(lines)) if is_html else "".join(lines)
+                number, lines = number + 1, []
+        if lines:
+            yield number, html_text("".join(lines)) if is_html else "".join(lines)
+
+def detect_format(path: str) -> Optional[str]:
+    """'pdf', 'epub', 'docx' or 'text' from the file's magic bytes (extension for text)"""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == b"%PDF":
+        return "pdf"
+    if magic == b"PK\x03\x04":
+        with zipfile.ZipFile(path) as archive:
+            names = set(archive.namelist())
+        if "word/document.xml" in names:
+            return "docx"
+        if "META-INF/container.xml" in names:
+            return "epub"
+        return None
+    if os.path.splitext(path)[1].lower() in TEXT_EXTENSIONS:
+        return "text"
+    return None
+
+EXTRACTORS = {"pdf": _pdf_pages, "epub": _epub_pages, "docx": _docx_pages, "text": _text_pages}
+
+def chunk_text(page_text: str, size: int = CHUNK_CHARS) -> Iterator[str]:
+    """Whitespace-normalized pieces of about size characters, split between words"""
+    words = page_text.split()
+    chunk, length = [], 0
+    for word in words:
+        if length + len(word) > size and chunk:
+            yield " ".join(chunk)
+            chunk, length = [], 0
+        chunk.append(word)
+        length += len(word) + 1
+    if chunk:
+        yield " ".join(chunk)
+
+# Indexing
+def _clear(db: Session, media_type: str, media_id: int, forget_source: bool = False) -> None:
+    db.query(ContentChunk).filter(
+        ContentChunk.media_type == media_type, ContentChunk.media_id == media_id
+    ).delete(synchronize_session=False)
+    if forget_source:
+        db.query(ContentSource).filter(
+            ContentSource.media_type == media_type, ContentSource.media_id == media_id
+        ).delete(synchronize_session=False)
+
+def _save_source(db: Session, **values) -> None:
+    stmt = sqlite_insert(ContentSource).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ContentSource.media_type, ContentSource.media_id],
+        set_={key: stmt.excluded[key] for key in values if key not in ("media_type", "media_id")}
+    )
+    db.execute(stmt)
+
+def _insert_chunks(db: Session, rows: List[dict]) -> None:
+    db.execute(insert(ContentChunk), rows)
+
+def _save_failure(db: Session, error: str, **values) -> None:
+    _clear(db, values["media_type"], values["media_id"])
+    _save_source(db, **values, status="failed", error=error)
+
+def index_file(db: Session, media_type: str, media_id: int, stop: Optional[threading.Event] = None) -> str:
+    """(Re)index one book or document; returns what happened
+
+    Files with the size and SHA-256 of the last run are skipped. Text is
+    written in batches of INSERT_BATCH_SIZE chunks while pages are extracted.
+    Once stop is set, extraction ends after the current page and the source
+    is left unrecorded, so the file is picked up again as stale.
+    """
+    obj = db.get(CONTENT_MODELS[media_type], media_id)
+    path = obj.file_path if obj else None
+    if not path or not os.path.isfile(path):
+        writer.queue.execute(db, lambda wdb: _clear(wdb, media_type, media_id, forget_source=True))
+        return "removed"
+
+    size = os.path.getsize(path)
+    digest = storage.blobs.digest_of(path) or storage.blobs.hash_file(path)
+    source = db.get(ContentSource, (media_type, media_id))
+    if source is not None and source.file_size == size and source.sha256 == digest:
+        return "unchanged"
+    db.rollback()  # end the read transaction before the long extraction
+
+    key = {"media_type": media_type, "media_id": media_id, "file_size": size, "sha256": digest}
+    file_format = detect_format(path)
+    writer.queue.execute(db, lambda wdb: _clear(wdb, media_type, media_id))
+    if file_format is None:
+        writer.queue.execute(db, lambda wdb: _save_source(wdb, **key, page_count=0, status="unsupported", error=None))
+        return "unsupported"
+
+    rows, page_count = [], 0
+    try:
+        for page, page_text in EXTRACTORS[file_format](path):
+            if stop is not None and stop.is_set():
+                return "stopped"
+            page_count = page
+            rows.extend({"media_type": media_type, "media_id": media_id, "page": page, "text": chunk}
+                        for chunk in chunk_text(page_text))
+            if len(rows) >= INSERT_BATCH_SIZE:
+                batch, rows = rows, []
+                writer.queue.execute(db, lambda wdb: _insert_chunks(wdb, batch))
+        if rows:
+            writer.queue.execute(db, lambda wdb: _insert_chunks(wdb, rows))
+    except Exception as e:
+        logger.warning("Extracting %s %d (%s) failed: %s", media_type, media_id, path, e)
+        error = str(e)[:500]
+        writer.queue.execute(db, lambda wdb: _save_failure(wdb, error, **key, page_count=page_count))
+        return "failed"
+    writer.queue.execute(db, lambda wdb: _save_source(wdb, **key, page_count=page_count, status="indexed", error=None))
+    return "indexed"
+
+class ContentIndexer:
+    """Worker pool extracting files in the background
+
+    Each file is queued at most once and never extracted by two workers at a
+    time: a file submitted while it is being extracted runs once more afterwards.
+    """
+
+    def __init__(self, workers: int = WORKERS):
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queued = set()
+        self._running = set()
+        self._rerun = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._stopping.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="content-index")
+
+    def stop(self) -> None:
+        """Drop queued files and wait for running ones to stop (before the write queue stops)"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._queued.clear()
+            self._rerun.clear()
+        if executor is not None:
+            self._stopping.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, media_type: str, media_id: int) -> None:
+        with self._lock:
+            self._submit((media_type, media_id))
+
+    def _submit(self, key: Tuple[str, int]) -> None:
+        if self._executor is None or key in self._queued:
+            return
+        if key in self._running:
+            self._rerun.add(key)
+            return
+        self._queued.add(key)
+        self._executor.submit(self._run, *key)
+
+    def _run(self, media_type: str, media_id: int) -> None:
+        key = (media_type, media_id)
+        with self._lock:
+            self._queued.discard(key)
+            self._running.add(key)
+        db = SessionLocal()
+        try:
+            result = index_file(db, media_type, media_id, self._stopping)
+            logger.debug("Content of %s %d: %s", media_type, media_id, result)
+        except Exception:
+            logger.exception("Indexing %s %d failed", media_type, media_id)
+        finally:
+            db.close()
+            with self._lock:
+                self._running.discard(key)
+                if key in self._rerun:
+                    self._rerun.discard(key)
+                    self._submit(key)
+
+indexer = ContentIndexer()
+
+def _file_changed(db: Session, media_type: str, obj) -> bool:
+    """Whether an updated row may point at other content than was last indexed"""
+    source = db.get(ContentSource, (media_type, obj.id))
+    if source is None:
+        return True
+    digest = storage.blobs.digest_of(obj.file_path) if obj.file_path else None
+    return obj.file_size != source.file_size or (digest is not None and digest != source.sha256)
+
+def _listener(media_type: str):
+    def listener(db: Session, event: str, obj) -> None:
+        # Edits of other fields (title, description) leave the content as it is
+        if event == "update" and not _file_changed(db, media_type, obj):
+            return
+        # The worker re-checks the file, deleted rows just get their chunks removed
+        indexer.submit(media_type, obj.id)
+    return listener
+
+for _media_type in CONTENT_MODELS:
+    crud.media_by_type[_media_type].add_listener(_listener(_media_type))
+
+def stale_files(db: Session) -> Iterator[Tuple[str, int]]:
+    """Books and documents never indexed or whose file size or content-addressed path changed"""
+    for media_type, model in CONTENT_MODELS.items():
+        sources = {
+            media_id: (file_size, sha256) for media_id, file_size, sha256 in db.query(
+                ContentSource.media_id, ContentSource.file_size, ContentSource.sha256
+            ).filter(ContentSource.media_type == media_type)
+        }
+        for media_id, path in db.query(model.id, model.file_path).yield_per(1000):
+            if not path or not os.path.isfile(path):
+                continue
+            known = sources.get(media_id)
+            digest = storage.blobs.digest_of(path)
+            if known is None or known[0] != os.path.getsize(path) or (digest and digest != known[1]):
+                yield media_type, media_id
+
+def queue_stale_files() -> int:
+    db = SessionLocal()
+    try:
+        stale = list(stale_files(db))
+    finally:
+        db.close()
+    for media_type, media_id in stale:
+        indexer.submit(media_type, media_id)
+    return len(stale)
+
+def _match_query(query: str) -> Optional[str]:
+    # Every word must occur; quoting keeps FTS5 operators in user input literal
+    words = re.findall(r"\w+", query)
+    return " ".join('"' + word + '"' for word in words) if words else None
+
+def search(db: Session, query: str, media_type: Optional[str] = None, limit: int = 20) -> List[dict]:
+    """Best matching pages by BM25 with a highlighted snippet, one hit per page"""
+    match = _match_query(query)
+    if match is None:
+        return []
+    type_filter = "AND c.media_type = :media_type" if media_type else ""
+    rows = db.execute(text(f"""
+        SELECT c.media_type, c.media_id, c.page,
+               snippet(content_fts, 0, '<b>', '</b>', '…', 16) AS snippet,
+               bm25(content_fts) AS score
+        FROM content_fts JOIN content_chunks c ON c.id = content_fts.rowid
+        WHERE content_fts MATCH :match {type_filter}
+        ORDER BY score LIMIT :limit
+    """), {"match": match, "media_type": media_type, "limit": limit * 4})
+    hits, seen = [], set()
+    for row in rows:
+        page_key = (row.media_type, row.media_id, row.page)
+        if page_key in seen:
+            continue
+        seen.add(page_key)
+        hits.append({"media_type": row.media_type, "id": row.media_id, "page": row.page,
+                     "snippet": row.snippet, "score": round(-row.score, 4)})
+        if len(hits) == limit:
+            break
+    return hits
+
+if __name__ == "__main__":
+    from database import engine
+    create_fts_index(engine)
+    session = SessionLocal()
+    try:
+        counts = {}
+        for stale_type, stale_id in list(stale_files(session)):
+            result = index_file(session, stale_type, stale_id)
+            counts[result] = counts.get(result, 0) + 1
+        print(f"Indexed content: {counts}")
+    finally:
+        session.close()
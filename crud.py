@@ -1,47 +1,277 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
-from typing import List, Optional, Type, TypeVar, Generic
-from models import Photo, Video, Book, UserDocument, Character, Review
+from sqlalchemy.orm import Session, Query
+from sqlalchemy import or_, and_, delete, exists, func, insert, literal, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Callable, List, Optional, Type, TypeVar, Generic
+import threading
+import time
+from models import Photo, Video, Book, UserDocument, Character, Review, ReviewRollup, MediaRating, PhotoHash, ChangeLog
+from models import character_photo, character_video, character_book
 import schemas
+import storage
+import writer
 
 ModelType = TypeVar('ModelType')
 
+# Range filters of schemas.MediaFilter and the column they bound
+LOWER_BOUND_FILTERS = {"created_from": "created_at", "min_size": "file_size", "min_rating": "rating"}
+UPPER_BOUND_FILTERS = {"created_to": "created_at", "max_size": "file_size", "max_rating": "rating"}
+
+# Character association tables and the media type each links
+CHARACTER_LINKS = {character_photo: "photo", character_video: "video", character_book: "book"}
+
+# Rows deleted per write operation by compaction jobs, keeps the writer free for requests
+COMPACT_BATCH_SIZE = 500
+# Pause between batches so request writes are not queued behind a long run
+COMPACT_PAUSE_SECONDS = 0.05
+
+def delete_in_batches(db: Session, statement: str, params: Optional[dict] = None,
+                      batch_size: int = COMPACT_BATCH_SIZE,
+                      record: Optional[Callable[[Session, list], None]] = None) -> int:
+    """Run a DELETE ... LIMIT :batch statement through the write queue until it stops matching rows
+
+    With record, the statement ends in RETURNING and record(db, rows) runs in
+    the same operation, e.g. to write change log entries for the removed rows.
+    """
+    def delete_batch(wdb: Session) -> int:
+        result = wdb.execute(text(statement), {**(params or {}), "batch": batch_size})
+        if record is None:
+            return result.rowcount
+        rows = result.all()
+        record(wdb, rows)
+        return len(rows)
+
+    total = 0
+    while True:
+        deleted = writer.queue.execute(db, delete_batch, attach=False)
+        total += deleted
+        if deleted < batch_size:
+            return total
+        time.sleep(COMPACT_PAUSE_SECONDS)
+
 class CRUDBase(Generic[ModelType]):
-    def __init__(self, model: Type[ModelType]):
+    # Filters and sort keys accepted by get_multi
+    filter_fields: frozenset = frozenset()
+    sort_fields: frozenset = frozenset({"id"})
+    # Index name -> columns, created by init_db.py. Equality filters, then at most
+    # one range filter and a sort key, are only accepted together when one of these
+    # indexes starts with the equality columns followed by the range/sort column.
+    list_indexes: dict = {}
+    # Filter name -> model attribute, for models whose column is named differently
+    column_aliases: dict = {}
+    # Tables holding this entity's id without a cascading foreign key: (table, column)
+    link_tables: tuple = ()
+    # Entity name recorded in the change log
+    entity: str = ""
+
+    def __init__(self, model: Type[ModelType], media_type: Optional[str] = None):
         self.model = model
+        # Value of Review.media_type pointing at this model (None for non-media entities)
+        self.media_type = media_type
+        self._listeners = []
+
+    def add_listener(self, callback: Callable[[Session, str, ModelType], None]) -> None:
+        """Call callback(db, event, obj) after each committed create, update or delete
+
+        CRUDCharacter also reports new media links as a "link" event with
+        obj = (character_id, media_type, media_id).
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, db: Session, event: str, obj: ModelType) -> None:
+        for callback in self._listeners:
+            callback(db, event, obj)
 
     def get(self, db: Session, id: int) -> Optional[ModelType]:
         return db.query(self.model).filter(self.model.id == id).first()
 
-    def get_multi(self, db: Session, skip: int = 0, limit: int = 100) -> List[ModelType]:
-        return db.query(self.model).offset(skip).limit(limit).all()
+    def get_many(self, db: Session, ids: List[int]) -> List[Optional[ModelType]]:
+        """Rows for ids in the given order, None where an id does not exist (one IN query)"""
+        found = {obj.id: obj for obj in db.query(self.model).filter(self.model.id.in_(set(ids)))}
+        return [found.get(id) for id in ids]
+
+    def get_multi(self, db: Session, skip: int = 0, limit: int = 100,
+                  filters: Optional[schemas.MediaFilter] = None) -> List[ModelType]:
+        query = db.query(self.model)
+        if filters is not None:
+            query = self._apply_filters(db, query, filters)
+        return query.offset(skip).limit(limit).all()
+
+    def _column(self, name: str):
+        return getattr(self.model, self.column_aliases.get(name, name))
+
+    def _apply_filters(self, db: Session, query: Query, filters: schemas.MediaFilter) -> Query:
+        """Apply whitelisted filters and sort order, raises ValueError for anything else"""
+        params = filters.model_dump(exclude_none=True)
+        sort = params.pop("sort", None)
+
+        unsupported = set(params) - self.filter_fields
+        if unsupported:
+            raise ValueError(
+                f"Unsupported filter(s) for {self.model.__tablename__}: {', '.join(sorted(unsupported))}"
+            )
+        if sort and sort.lstrip("-") not in self.sort_fields:
+            raise ValueError(
+                f"Unsupported sort key '{sort.lstrip('-')}', expected one of: {', '.join(sorted(self.sort_fields))}"
+            )
+        self._check_indexed(params, sort.lstrip("-") if sort else None)
+
+        rating_filters = {}
+        for name, value in params.items():
+            if isinstance(value, Enum):
+                value = value.value
+            if name in ("min_rating", "max_rating") and self.media_type:
+                rating_filters[name] = value
+            elif name == "has_character":
+                # Correlated, so the row order comes from the sort index and each row
+                # probes the (media_id, character_id) index of the link table
+                link_table, column = next((table, column) for table, column in self.link_tables
+                                          if "character_id" in table.c)
+                linked = exists().where(link_table.c[column] == self.model.id)
+                query = query.filter(linked if value else ~linked)
+            elif name in LOWER_BOUND_FILTERS:
+                query = query.filter(self._column(LOWER_BOUND_FILTERS[name]) >= value)
+            elif name in UPPER_BOUND_FILTERS:
+                query = query.filter(self._column(UPPER_BOUND_FILTERS[name]) <= value)
+            else:
+                query = query.filter(self._column(name) == value)
+
+        if rating_filters:
+            # Media whose average review rating is in the range, a range scan
+            # of the (media_type, average_rating) index of media_ratings
+            rated = db.query(MediaRating.media_id).filter(MediaRating.media_type == self.media_type)
+            if "min_rating" in rating_filters:
+                rated = rated.filter(MediaRating.average_rating >= rating_filters["min_rating"])
+            if "max_rating" in rating_filters:
+                rated = rated.filter(MediaRating.average_rating <= rating_filters["max_rating"])
+            query = query.filter(self.model.id.in_(rated))
+
+        if sort:
+            descending = sort.startswith("-")
+            key = sort.lstrip("-")
+            column = self._column(key)
+            query = query.order_by(column.desc() if descending else column.asc())
+            # Tie-breaker keeps pages stable when the sort column has duplicates
+            if key != "id":
+                query = query.order_by(self.model.id.desc() if descending else self.model.id.asc())
+        return query
 
+    def _check_indexed(self, params: dict, sort_key: Optional[str]) -> None:
+        """Raise ValueError unless one of list_indexes serves these filters and sort key
+
+        The rating and has_character filters combine with anything: the rating
+        filter is an id set from a range scan of the media_ratings index, and
+        has_character an index probe of the link table per row. Sorting by id
+        only orders the matching rows.
+        """
+        equal, ranged = set(), set()
+        for name in params:
+            if name in LOWER_BOUND_FILTERS or name in UPPER_BOUND_FILTERS:
+                column = LOWER_BOUND_FILTERS.get(name) or UPPER_BOUND_FILTERS[name]
+                if not (column == "rating" and self.media_type):
+                    ranged.add(self.column_aliases.get(column, column))
+            elif name != "has_character":
+                equal.add(self.column_aliases.get(name, name))
+        sort_column = None if sort_key in (None, "id") else self.column_aliases.get(sort_key, sort_key)
+        if len(ranged) > 1 or (ranged and sort_column and sort_column not in ranged):
+            raise ValueError("A range filter can only be combined with a sort on the same column (or id)")
+        order_column = next(iter(ranged), sort_column)
+        if not equal and order_column is None:
+            return
+        for columns in self.list_indexes.values():
+            if set(columns[:len(equal)]) != equal:
+                continue
+            if order_column is None or columns[len(equal):len(equal) + 1] == (order_column,):
+                return
+        raise ValueError(
+            f"Unsupported filter/sort combination for {self.model.__tablename__}: "
+            f"{', '.join(sorted(params)) or 'no filters'}, sort {sort_key or 'id'}"
+        )
+
+    # Writes are group-committed by writer.queue: the _create/_update/_delete
+    # operations run on the writer's session and leave the commit to it. Each
+    # is a single INSERT/UPDATE/DELETE ... RETURNING, so no row is read first;
+    # update and delete return None when no row has the id.
     def create(self, db: Session, obj_in: schemas.BaseModel) -> ModelType:
-        obj_in_data = obj_in.model_dump()
-        db_obj = self.model(**obj_in_data)
-        db.add(db_obj)
-        db.commit()
-        db.refresh(db_obj)
+        return writer.queue.execute(db, lambda wdb: self._create(wdb, obj_in), self._on_commit("create"))
+
+    def update(self, db: Session, id: int, obj_in: schemas.BaseModel) -> Optional[ModelType]:
+        return writer.queue.execute(db, lambda wdb: self._update(wdb, id, obj_in), self._on_commit("update"))
+
+    def delete(self, db: Session, id: int) -> Optional[ModelType]:
+        return writer.queue.execute(db, lambda wdb: self._delete(wdb, id), self._on_commit("delete"), attach=False)
+
+    def _on_commit(self, event: str) -> Callable[[Session, ModelType], None]:
+        return lambda db, obj: self._notify(db, event, obj)
+
+    def _create(self, db: Session, obj_in: schemas.BaseModel) -> ModelType:
+        db_obj = db.scalars(insert(self.model).returning(self.model), [obj_in.model_dump()]).one()
+        change_log.record(db, self.entity, db_obj.id, "create")
+        if self.media_type:
+            storage.blobs.acquire(db, db_obj.file_path)
         return db_obj
 
-    def update(self, db: Session, db_obj: ModelType, obj_in: schemas.BaseModel) -> ModelType:
+    def _update(self, db: Session, id: int, obj_in: schemas.BaseModel) -> Optional[ModelType]:
         obj_data = obj_in.model_dump(exclude_unset=True)
-        for field in obj_data:
-            setattr(db_obj, field, obj_data[field])
-        db.add(db_obj)
-        db.commit()
-        db.refresh(db_obj)
+        if not obj_data:
+            return db.get(self.model, id)
+        db_obj = db.scalars(
+            update(self.model).where(self.model.id == id).values(**obj_data).returning(self.model)
+        ).one_or_none()
+        if db_obj is not None:
+            change_log.record(db, self.entity, id, "update")
         return db_obj
 
-    def delete(self, db: Session, id: int) -> Optional[ModelType]:
-        obj = db.query(self.model).filter(self.model.id == id).first()
-        if obj:
-            db.delete(obj)
-            db.commit()
+    def _delete(self, db: Session, id: int) -> Optional[ModelType]:
+        obj = db.scalars(delete(self.model).where(self.model.id == id).returning(self.model)).one_or_none()
+        if obj is not None:
+            self._delete_dependents(db, id)
+            change_log.record(db, self.entity, id, "delete")
+            if self.media_type:
+                storage.blobs.release(db, obj.file_path)
         return obj
 
+    def _delete_dependents(self, db: Session, id: int) -> None:
+        """Remove rows referring to this entity without a foreign key, in the caller's transaction"""
+        for table, column in self.link_tables:
+            statement = table.delete().where(table.c[column] == id)
+            media_type = CHARACTER_LINKS.get(table)
+            if media_type is None:
+                db.execute(statement)
+                continue
+            # Clients mirroring links see the removal like they saw the link
+            media_column = table.c[media_type + "_id"]
+            for character_id, media_id in db.execute(statement.returning(table.c.character_id, media_column)):
+                change_log.record(db, "character", character_id, "unlink", media_type, media_id)
+        if self.media_type:
+            reviews = db.query(Review).filter(Review.media_type == self.media_type, Review.media_id == id)
+            for (review_id,) in reviews.with_entities(Review.id):
+                change_log.record(db, "review", review_id, "delete")
+            reviews.delete(synchronize_session=False)
+            db.query(ReviewRollup).filter(
+                ReviewRollup.media_type == self.media_type, ReviewRollup.media_id == id
+            ).delete(synchronize_session=False)
+            db.query(MediaRating).filter(
+                MediaRating.media_type == self.media_type, MediaRating.media_id == id
+            ).delete(synchronize_session=False)
+
 # Photo CRUD
 class CRUDPhoto(CRUDBase[Photo]):
+    entity = "photo"
+    filter_fields = frozenset({"file_type", "created_from", "created_to", "min_size", "max_size",
+                               "min_rating", "max_rating", "has_character"})
+    sort_fields = frozenset({"id", "title", "created_at", "file_size"})
+    list_indexes = {
+        "idx_photo_type_created": ("file_type", "created_at"),
+        "idx_photo_type_size": ("file_type", "file_size"),
+        "idx_photo_type_title": ("file_type", "title"),
+        "idx_photo_created": ("created_at",),
+        "idx_photo_size": ("file_size",),
+        "idx_photo_title": ("title",),
+    }
+    link_tables = ((character_photo, "photo_id"), (PhotoHash.__table__, "photo_id"))
+
     def search_by_title(self, db: Session, title: str, limit: int = 20) -> List[Photo]:
         return db.query(Photo).filter(Photo.title.ilike(f"%{title}%")).limit(limit).all()
     
@@ -49,10 +279,24 @@ class CRUDPhoto(CRUDBase[Photo]):
         character = db.query(Character).filter(Character.id == character_id).first()
         return character.photos if character else []
 
-photo = CRUDPhoto(Photo)
+photo = CRUDPhoto(Photo, media_type="photo")
 
 # Video CRUD
 class CRUDVideo(CRUDBase[Video]):
+    entity = "video"
+    filter_fields = frozenset({"file_type", "created_from", "created_to", "min_size", "max_size",
+                               "min_rating", "max_rating", "has_character"})
+    sort_fields = frozenset({"id", "title", "created_at", "file_size"})
+    list_indexes = {
+        "idx_video_type_created": ("file_type", "created_at"),
+        "idx_video_type_size": ("file_type", "file_size"),
+        "idx_video_type_title": ("file_type", "title"),
+        "idx_video_created": ("created_at",),
+        "idx_video_size": ("file_size",),
+        "idx_video_title": ("title",),
+    }
+    link_tables = ((character_video, "video_id"),)
+
     def search_by_title(self, db: Session, title: str, limit: int = 20) -> List[Video]:
         return db.query(Video).filter(Video.title.ilike(f"%{title}%")).limit(limit).all()
     
@@ -60,10 +304,28 @@ class CRUDVideo(CRUDBase[Video]):
         character = db.query(Character).filter(Character.id == character_id).first()
         return character.videos if character else []
 
-video = CRUDVideo(Video)
+video = CRUDVideo(Video, media_type="video")
 
 # Book CRUD
 class CRUDBook(CRUDBase[Book]):
+    entity = "book"
+    filter_fields = frozenset({"file_type", "author", "created_from", "created_to", "min_size", "max_size",
+                               "min_rating", "max_rating", "has_character"})
+    sort_fields = frozenset({"id", "title", "created_at", "file_size"})
+    column_aliases = {"file_type": "file_format"}
+    list_indexes = {
+        "idx_book_format_created": ("file_format", "created_at"),
+        "idx_book_format_size": ("file_format", "file_size"),
+        "idx_book_format_title": ("file_format", "title"),
+        "idx_book_author_created": ("author", "created_at"),
+        "idx_book_author_size": ("author", "file_size"),
+        "idx_book_author_title": ("author", "title"),
+        "idx_book_created": ("created_at",),
+        "idx_book_size": ("file_size",),
+        "idx_book_title": ("title",),
+    }
+    link_tables = ((character_book, "book_id"),)
+
     def search_by_title(self, db: Session, title: str, limit: int = 20) -> List[Book]:
         return db.query(Book).filter(Book.title.ilike(f"%{title}%")).limit(limit).all()
     
@@ -74,51 +336,299 @@ class CRUDBook(CRUDBase[Book]):
         character = db.query(Character).filter(Character.id == character_id).first()
         return character.books if character else []
 
-book = CRUDBook(Book)
+book = CRUDBook(Book, media_type="book")
 
 # UserDocument CRUD
 class CRUDUserDocument(CRUDBase[UserDocument]):
+    entity = "document"
+    filter_fields = frozenset({"created_from", "created_to", "min_size", "max_size", "min_rating", "max_rating"})
+    sort_fields = frozenset({"id", "title", "created_at", "file_size"})
+    list_indexes = {
+        "idx_document_created": ("created_at",),
+        "idx_document_size": ("file_size",),
+        "idx_document_title": ("title",),
+    }
+
     def search_by_title(self, db: Session, title: str, limit: int = 20) -> List[UserDocument]:
         return db.query(UserDocument).filter(UserDocument.title.ilike(f"%{title}%")).limit(limit).all()
 
-user_document = CRUDUserDocument(UserDocument)
+user_document = CRUDUserDocument(UserDocument, media_type="document")
 
 # Character CRUD
 class CRUDCharacter(CRUDBase[Character]):
+    entity = "character"
+    sort_fields = frozenset({"id", "name"})
+    list_indexes = {"idx_character_name": ("name",)}
+    link_tables = ((character_photo, "character_id"), (character_video, "character_id"), (character_book, "character_id"))
+
     def search_by_name(self, db: Session, name: str, limit: int = 20) -> List[Character]:
         return db.query(Character).filter(Character.name.ilike(f"%{name}%")).limit(limit).all()
     
-    def add_photo(self, db: Session, character_id: int, photo_id: int) -> Character:
-        character = self.get(db, character_id)
-        photo = db.query(Photo).filter(Photo.id == photo_id).first()
-        if character and photo:
-            character.photos.append(photo)
-            db.commit()
-            db.refresh(character)
-        return character
+    def add_photo(self, db: Session, character_id: int, photo_id: int) -> Optional[Character]:
+        return self._add_media(db, character_id, Photo, "photo", photo_id)
     
-    def add_video(self, db: Session, character_id: int, video_id: int) -> Character:
-        character = self.get(db, character_id)
-        video = db.query(Video).filter(Video.id == video_id).first()
-        if character and video:
-            character.videos.append(video)
-            db.commit()
-            db.refresh(character)
-        return character
+    def add_video(self, db: Session, character_id: int, video_id: int) -> Optional[Character]:
+        return self._add_media(db, character_id, Video, "video", video_id)
     
-    def add_book(self, db: Session, character_id: int, book_id: int) -> Character:
-        character = self.get(db, character_id)
-        book = db.query(Book).filter(Book.id == book_id).first()
-        if character and book:
-            character.books.append(book)
-            db.commit()
-            db.refresh(character)
-        return character
+    def add_book(self, db: Session, character_id: int, book_id: int) -> Optional[Character]:
+        return self._add_media(db, character_id, Book, "book", book_id)
+
+    def _add_media(self, db: Session, character_id: int, model: Type, media_type: str,
+                   media_id: int) -> Optional[Character]:
+        """Link a media object to a character; None if either does not exist"""
+        def link(wdb: Session) -> Optional[Character]:
+            character = wdb.get(Character, character_id)
+            media = wdb.get(model, media_id)
+            if character is None or media is None:
+                return None
+            getattr(character, media_type + "s").append(media)
+            change_log.record(wdb, "character", character_id, "link", media_type, media_id)
+            wdb.flush()
+            return character
+        return writer.queue.execute(
+            db, link, lambda db, character: self._notify(db, "link", (character_id, media_type, media_id))
+        )
 
 character = CRUDCharacter(Character)
 
+# Review rollups: per (media_type, media_id, day) counts and rating sums
+class CRUDReviewRollup:
+    # Daily buckets older than this are merged into monthly ones by compact()
+    daily_retention_days = 90
+    # How long a computed ranking is served from the top-K cache
+    cache_ttl_seconds = 30
+    cache_max_entries = 256
+
+    def __init__(self):
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def apply(self, db: Session, media_type: str, media_id: int, day: date,
+              count_delta: int, rating_delta: int) -> None:
+        """Add deltas to one bucket and to the media's average; runs inside the caller's transaction"""
+        stmt = sqlite_insert(ReviewRollup).values(
+            media_type=media_type, media_id=media_id, day=day,
+            review_count=count_delta, rating_sum=rating_delta
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ReviewRollup.media_type, ReviewRollup.day, ReviewRollup.media_id],
+            set_={
+                "review_count": ReviewRollup.review_count + stmt.excluded.review_count,
+                "rating_sum": ReviewRollup.rating_sum + stmt.excluded.rating_sum,
+            }
+        )
+        db.execute(stmt)
+
+        stmt = sqlite_insert(MediaRating).values(
+            media_type=media_type, media_id=media_id, review_count=count_delta, rating_sum=rating_delta,
+            average_rating=rating_delta / count_delta if count_delta > 0 else None
+        )
+        review_count = MediaRating.review_count + stmt.excluded.review_count
+        rating_sum = MediaRating.rating_sum + stmt.excluded.rating_sum
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[MediaRating.media_type, MediaRating.media_id],
+            set_={
+                "review_count": review_count,
+                "rating_sum": rating_sum,
+                "average_rating": rating_sum * 1.0 / func.nullif(review_count, 0),
+            }
+        )
+        db.execute(stmt)
+
+    def record(self, db: Session, review: Review, count_delta: int, rating_delta: int) -> None:
+        """Apply deltas to the bucket the review belongs to"""
+        created = review.created_at or datetime.utcnow()
+        self.apply(db, schemas.MediaType(review.media_type).value, review.media_id,
+                   created.date(), count_delta, rating_delta)
+
+    def rank(self, db: Session, media_type: schemas.MediaType, window_days: int,
+             by: schemas.RankingMetric, limit: int = 50) -> List[dict]:
+        key = (media_type.value, window_days, by.value, limit)
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        since = datetime.utcnow().date() - timedelta(days=window_days - 1)
+        in_window = and_(ReviewRollup.media_type == media_type.value, ReviewRollup.day >= since)
+        count = func.sum(ReviewRollup.review_count)
+        total = func.sum(ReviewRollup.rating_sum)
+        average = total * 1.0 / count
+
+        if by == schemas.RankingMetric.COUNT:
+            score = count * 1.0
+        elif by == schemas.RankingMetric.AVG:
+            score = average
+        else:
+            # Bayesian average: shrink each item towards the window-wide mean rating,
+            # weighted by the mean number of reviews per item in the window
+            prior_count, prior_total, items = db.query(
+                func.sum(ReviewRollup.review_count),
+                func.sum(ReviewRollup.rating_sum),
+                func.count(func.distinct(ReviewRollup.media_id))
+            ).filter(in_window).one()
+            if not prior_count:
+                return []
+            prior_mean = prior_total / prior_count
+            prior_weight = prior_count / items
+            score = (literal(prior_weight * prior_mean) + total) / (literal(prior_weight) + count)
+
+        rows = db.query(
+            ReviewRollup.media_id, count.label("review_count"), average.label("average_rating"), score.label("score")
+        ).filter(in_window).group_by(ReviewRollup.media_id).having(count > 0).order_by(
+            score.desc(), ReviewRollup.media_id
+        ).limit(limit).all()
+
+        results = [
+            {
+                "media_type": media_type,
+                "media_id": row.media_id,
+                "review_count": row.review_count,
+                "average_rating": round(row.average_rating, 3),
+                "score": round(row.score, 3),
+            }
+            for row in rows
+        ]
+        with self._cache_lock:
+            if len(self._cache) >= self.cache_max_entries:
+                self._cache.clear()
+            self._cache[key] = (now + self.cache_ttl_seconds, results)
+        return results
+
+    def compact(self, db: Session) -> int:
+        """Merge daily buckets past the retention into monthly buckets, returns merged row count
+
+        Each month is merged in its own write queue operation, so a first run
+        over a large table does not hold up request writes for long.
+        """
+        cutoff = datetime.utcnow().date() - timedelta(days=self.daily_retention_days)
+        old_buckets = "day < :cutoff AND day != date(day, 'start of month')"
+        months = db.execute(text(f"""
+            SELECT DISTINCT date(day, 'start of month') FROM review_rollups WHERE {old_buckets}
+        """), {"cutoff": cutoff.isoformat()}).scalars().all()
+        merged = 0
+        for month in months:
+            params = {"cutoff": cutoff.isoformat(), "month": month}
+            merged += writer.queue.execute(db, lambda wdb: self._merge_month(wdb, params), attach=False)
+        # Buckets emptied by review deletes
+        for table in ("review_rollups", "media_ratings"):
+            delete_in_batches(db, f"""
+                DELETE FROM {table} WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE review_count <= 0 LIMIT :batch
+                )
+            """)
+        return merged
+
+    @staticmethod
+    def _merge_month(db: Session, params: dict) -> int:
+        # Daily buckets of one month before the cutoff, the monthly bucket itself excluded
+        month_days = "day > :month AND day < date(:month, '+1 month') AND day < :cutoff"
+        db.execute(text(f"""
+            INSERT INTO review_rollups (media_type, day, media_id, review_count, rating_sum)
+            SELECT media_type, :month, media_id, SUM(review_count), SUM(rating_sum)
+            FROM review_rollups WHERE {month_days}
+            GROUP BY media_type, media_id
+            ON CONFLICT (media_type, day, media_id) DO UPDATE SET
+                review_count = review_count + excluded.review_count,
+                rating_sum = rating_sum + excluded.rating_sum
+        """), params)
+        return db.execute(text(f"DELETE FROM review_rollups WHERE {month_days}"), params).rowcount
+
+    def rebuild(self, db: Session) -> None:
+        """Recompute all buckets and averages from the reviews table (backfill / repair)"""
+        db.execute(text("DELETE FROM review_rollups"))
+        db.execute(text("""
+            INSERT INTO review_rollups (media_type, day, media_id, review_count, rating_sum)
+            SELECT media_type, date(created_at), media_id, COUNT(*), SUM(rating)
+            FROM reviews WHERE created_at IS NOT NULL
+            GROUP BY media_type, date(created_at), media_id
+        """))
+        db.execute(text("DELETE FROM media_ratings"))
+        db.execute(text("""
+            INSERT INTO media_ratings (media_type, media_id, review_count, rating_sum, average_rating)
+            SELECT media_type, media_id, COUNT(*), SUM(rating), AVG(rating)
+            FROM reviews GROUP BY media_type, media_id
+        """))
+        db.commit()
+
+review_rollup = CRUDReviewRollup()
+
+# Change log: every committed write in order, so clients can sync deltas
+class CRUDChangeLog:
+    # Entries older than this are removed by compact(); clients with an older cursor must re-list
+    retention_days = 30
+
+    def record(self, db: Session, entity: str, entity_id: int, op: str,
+               related_type: Optional[str] = None, related_id: Optional[int] = None) -> None:
+        """Append an entry; runs inside the caller's transaction so it commits with the change"""
+        db.add(ChangeLog(entity=entity, entity_id=entity_id, op=op,
+                         related_type=related_type, related_id=related_id))
+
+    def latest(self, db: Session) -> int:
+        return db.query(func.max(ChangeLog.id)).scalar() or 0
+
+    def since(self, db: Session, cursor: int, limit: int = 100) -> Optional[List[ChangeLog]]:
+        """Entries after cursor in commit order, None if entries after it were compacted away"""
+        oldest = db.query(func.min(ChangeLog.id)).scalar()
+        if oldest is not None and cursor < oldest - 1:
+            return None
+        return db.query(ChangeLog).filter(ChangeLog.id > cursor).order_by(ChangeLog.id).limit(limit).all()
+
+    def compact(self, db: Session) -> int:
+        """Delete entries past the retention, returns the number removed
+
+        The newest expired entry is kept so the lowest remaining id marks
+        where the log was cut, which since() uses to detect expired cursors.
+        """
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        horizon = db.query(func.max(ChangeLog.id)).filter(ChangeLog.changed_at < cutoff).scalar()
+        if horizon is None:
+            return 0
+        return delete_in_batches(db, f"""
+            DELETE FROM {ChangeLog.__tablename__} WHERE id IN (
+                SELECT id FROM {ChangeLog.__tablename__} WHERE id < :horizon ORDER BY id LIMIT :batch
+            )
+        """, {"horizon": horizon})
+
+change_log = CRUDChangeLog()
+
 # Review CRUD
 class CRUDReview(CRUDBase[Review]):
+    entity = "review"
+    filter_fields = frozenset({"media_type", "created_from", "created_to", "min_rating", "max_rating"})
+    sort_fields = frozenset({"id", "rating", "created_at"})
+    list_indexes = {
+        "idx_review_type_created": ("media_type", "created_at"),
+        "idx_review_type_rating": ("media_type", "rating"),
+        "idx_review_rating": ("rating",),
+        "idx_review_created": ("created_at",),
+    }
+
+    # Writes keep review_rollups in sync within the same transaction
+    def _create(self, db: Session, obj_in: schemas.ReviewCreate) -> Review:
+        db_obj = super()._create(db, obj_in)
+        review_rollup.record(db, db_obj, 1, db_obj.rating)
+        return db_obj
+
+    def _update(self, db: Session, id: int, obj_in: schemas.ReviewUpdate) -> Optional[Review]:
+        # RETURNING only sees the new row, so a rating change reads the old rating first
+        old_rating = None
+        if obj_in.rating is not None:
+            old_rating = db.scalar(select(Review.rating).where(Review.id == id))
+            if old_rating is None:
+                return None
+        db_obj = super()._update(db, id, obj_in)
+        if db_obj is not None and old_rating is not None and db_obj.rating not in (None, old_rating):
+            review_rollup.record(db, db_obj, 0, db_obj.rating - old_rating)
+        return db_obj
+
+    def _delete(self, db: Session, id: int) -> Optional[Review]:
+        obj = super()._delete(db, id)
+        if obj is not None:
+            review_rollup.record(db, obj, -1, -obj.rating)
+        return obj
+
     def get_by_media(self, db: Session, media_type: schemas.MediaType, media_id: int) -> List[Review]:
         return db.query(Review).filter(
             Review.media_type == media_type.value,
@@ -126,7 +636,6 @@ class CRUDReview(CRUDBase[Review]):
         ).all()
     
     def get_average_rating(self, db: Session, media_type: schemas.MediaType, media_id: int) -> Optional[float]:
-        from sqlalchemy import func
         result = db.query(func.avg(Review.rating)).filter(
             Review.media_type == media_type.value,
             Review.media_id == media_id
@@ -140,6 +649,18 @@ class CRUDReview(CRUDBase[Review]):
 
 review = CRUDReview(Review)
 
+# Media CRUD objects by Review.media_type value
+media_by_type = {crud_obj.media_type: crud_obj for crud_obj in (photo, video, book, user_document)}
+
+def get_media_many(db: Session, refs: List[tuple]) -> list:
+    """Resolve (media_type, media_id) pairs in order, one IN query per media type"""
+    found = {}
+    for media_type in {media_type for media_type, _ in refs}:
+        ids = [media_id for ref_type, media_id in refs if ref_type == media_type]
+        for media_id, obj in zip(ids, media_by_type[media_type].get_many(db, ids)):
+            found[(media_type, media_id)] = obj
+    return [found[ref] for ref in refs]
+
 # Global search function
 def search_media(db: Session, query: str, limit: int = 20) -> dict:
     """Search across all media types"""
@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from fastapi import Request
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
+import threading
 
 # Use the SQLite database in the current directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -11,12 +13,43 @@ engine = create_engine(
     connect_args={"check_same_thread": False}
 )
 
+# WAL lets readers, including long batch requests, run alongside the writer's
+# commits instead of holding a shared lock that blocks them
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+class SnapshotSession:
+    """A session holding one read transaction, shared by the reads of a batch
+
+    Every query sees the database as it was when the snapshot was opened.
+    Sessions are not thread-safe, so the requests using it take turns (get_db).
+    """
+
+    def __init__(self):
+        self.session = SessionLocal()
+        self.lock = threading.Lock()
+        connection = self.session.connection()
+        connection.exec_driver_sql("BEGIN")
+        # The snapshot is taken by the first read, not by BEGIN
+        connection.exec_driver_sql("SELECT count(*) FROM sqlite_master").scalar()
+
+    def close(self) -> None:
+        with self.lock:
+            self.session.rollback()
+            self.session.close()
+
 # Dependency for getting a DB session
-def get_db():
+def get_db(request: Request):
+    snapshot = request.scope.get("db_snapshot")
+    if snapshot is not None:
+        with snapshot.lock:
+            yield snapshot.session
+        return
     db = SessionLocal()
     try:
         yield db
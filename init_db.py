@@ -6,6 +6,8 @@ import random
 # Import models and base class
 from models import Base, Photo, Video, Book, UserDocument, Character, Review
 from models import character_photo, character_video, character_book
+import content
+import crud
 
 # Configuring Database Connection
 SQLALCHEMY_DATABASE_URL = "sqlite:///./media_gallery.db"
@@ -17,44 +19,49 @@ engine = create_engine(
 # Creating a Session Factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Indexes backing the list endpoints: the filter/sort indexes declared by each
+# CRUD class (list_indexes, which also decides what get_multi accepts), plus lookups
+FILTER_INDEXES = [
+    (name, crud_obj.model.__tablename__, ", ".join(columns))
+    for crud_obj in (crud.photo, crud.video, crud.book, crud.user_document, crud.character, crud.review)
+    for name, columns in crud_obj.list_indexes.items()
+] + [
+    # Reviews of one media object
+    ("idx_review_media_rating", "reviews", "media_type, media_id, rating"),
+
+    # has_character filter lookups (the primary keys start with character_id)
+    ("idx_character_photo_photo", "character_photo", "photo_id, character_id"),
+    ("idx_character_video_video", "character_video", "video_id, character_id"),
+    ("idx_character_book_book", "character_book", "book_id, character_id"),
+]
+
+def enable_incremental_vacuum():
+    
+    # auto_vacuum can only change before the first table exists or through a full VACUUM,
+    # so an existing database is rebuilt once; afterwards space is reclaimed incrementally
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+            conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+            conn.execute(text("VACUUM"))
+
 def create_tables_and_indexes():
     
+    enable_incremental_vacuum()
+    
     # Create all tables
     Base.metadata.create_all(bind=engine)
+    content.create_fts_index(engine)
     
    # Creating Indexes Using Raw SQL
     with engine.connect() as conn:
-        # Index to speed up the search for reviews by media object
-        conn.execute(text("""
-            CREATE INDEX IF NOT EXISTS idx_review_media_composite 
-            ON reviews (media_type, media_id);
-        """))
-        
-        # Indexes for searching by name
-        conn.execute(text("""
-            CREATE INDEX IF NOT EXISTS idx_photo_title 
-            ON photos (title);
-        """))
-        
-        conn.execute(text("""
-            CREATE INDEX IF NOT EXISTS idx_video_title 
-            ON videos (title);
-        """))
-        
-        conn.execute(text("""
-            CREATE INDEX IF NOT EXISTS idx_book_title 
-            ON books (title);
-        """))
-        
-        conn.execute(text("""
-            CREATE INDEX IF NOT EXISTS idx_document_title 
-            ON user_documents (title);
-        """))
-        
-        conn.execute(text("""
-            CREATE INDEX IF NOT EXISTS idx_character_name 
-            ON characters (name);
-        """))
+        # Indexes for the list endpoint filters and sort keys (title/name sorting
+        # included). Equality filters come first so the range filter or ORDER BY
+        # column can use the rest of the index.
+        for name, table, columns in FILTER_INDEXES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns});"))
+        
+        # Superseded by idx_review_media_rating
+        conn.execute(text("DROP INDEX IF EXISTS idx_review_media_composite;"))
         
         conn.commit()
     print("Таблицы и индексы успешно созданы")
@@ -194,6 +201,14 @@ def fill_test_data():
     finally:
         db.close()
 
+def rebuild_review_rollups():
+    
+    db = SessionLocal()
+    try:
+        crud.review_rollup.rebuild(db)
+    finally:
+        db.close()
+
 if __name__ == "__main__":
     # Creating tables and indexes
     create_tables_and_indexes()
@@ -201,4 +216,7 @@ if __name__ == "__main__":
     # Filling the database with test data
     fill_test_data()
     
+    # Backfill the review rollups and media averages used by rankings and the rating filter
+    rebuild_review_rollups()
+    
     print("Инициализация базы данных завершена")
\ No newline at end of file
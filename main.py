@@ -1,30 +1,119 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import os
+import threading
+import autocomplete
+import batch
+import capture
+import content
 import crud
 import models
+import profiling
 import schemas
+import storage
+import tasks
+import related
+import resumable
+import similarity
+import writer
 from database import SessionLocal, engine, get_db
 from datetime import datetime
-import shutil
+from urllib.parse import urlsplit
 
 
 # Create tables (if they haven't been created yet)
 models.Base.metadata.create_all(bind=engine)
+content.create_fts_index(engine)
 
 app = FastAPI(
     title="Media Gallery API",
     description="API для управления медиабиблиотекой с фотографиями, видео, книгами и документами",
     version="1.0.0"
 )
+# Set before the routes below are declared so every endpoint can be profiled
+app.router.route_class = profiling.ProfiledRoute
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(capture.CaptureMiddleware)
 
 
 # Create a download folder if it doesn't exist
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = storage.UPLOAD_DIR
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+@app.on_event("startup")
+async def start_background_jobs():
+    writer.queue.start()
+    similarity.fingerprinter.start()
+    if capture.writer:
+        capture.writer.start()
+    tasks.start()
+    # Load in the background so startup is not delayed; /similar answers 503 until ready
+    threading.Thread(target=similarity.load_index, name="photo-hash-index", daemon=True).start()
+    threading.Thread(target=autocomplete.rebuild_index, name="autocomplete-index", daemon=True).start()
+    threading.Thread(target=related.graph.warm, name="cooccurrence-graph", daemon=True).start()
+    # Extract text of books and documents added or changed while the app was down
+    content.indexer.start()
+    threading.Thread(target=content.queue_stale_files, name="content-scan", daemon=True).start()
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    await tasks.stop()
+    # Background workers write through the write queue, so they finish first
+    await run_in_threadpool(content.indexer.stop)
+    await run_in_threadpool(similarity.fingerprinter.stop)
+    await run_in_threadpool(writer.queue.stop)
+    if capture.writer:
+        await run_in_threadpool(capture.writer.stop)
+
+MEDIA_RESPONSE_SCHEMAS = {
+    "photo": schemas.PhotoResponse,
+    "video": schemas.VideoResponse,
+    "book": schemas.BookResponse,
+    "document": schemas.UserDocumentResponse,
+}
+
+def list_filtered(crud_obj: crud.CRUDBase, db: Session, skip: int, limit: int, filters: schemas.MediaFilter):
+    """Shared body of the list endpoints, unsupported filters and sort keys are client errors"""
+    try:
+        return crud_obj.get_multi(db, skip=skip, limit=limit, filters=filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Multi-get: ids are answered with one IN query, in request order, misses as null
+MAX_MULTI_GET_IDS = 200
+
+def parse_id_list(ids: str) -> List[str]:
+    items = [item.strip() for item in ids.split(",") if item.strip()]
+    if not items:
+        raise HTTPException(status_code=400, detail="No ids given")
+    if len(items) > MAX_MULTI_GET_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_MULTI_GET_IDS} ids per request")
+    return items
+
+def redirect_to_collection(request: Request):
+    """307 to the trailing-slash route, as for paths without a route of their own"""
+    return RedirectResponse(url=str(request.url.replace(path=request.url.path + "/")))
+
+def read_many(crud_obj: crud.CRUDBase, request: Request, ids: Optional[str], db: Session):
+    if ids is None:
+        # Without ids this is the list endpoint, which lives at the trailing-slash path
+        return redirect_to_collection(request)
+    try:
+        id_list = [int(item) for item in parse_id_list(ids)]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Ids must be integers")
+    items = crud_obj.get_many(db, id_list)
+    return {"items": items, "missing": [id for id, item in zip(id_list, items) if item is None]}
+
+# The slash-less collection paths only route GET (multi-get); other methods
+# keep being redirected to the trailing-slash routes, e.g. POST /api/v1/photos
+for _collection in ("photos", "videos", "books", "documents", "characters", "reviews"):
+    app.add_api_route(f"/api/v1/{_collection}", redirect_to_collection,
+                      methods=["POST", "PUT", "PATCH", "DELETE"], include_in_schema=False)
+
 # Basic endpoints
 @app.get("/")
 async def root():
@@ -40,9 +129,18 @@ def create_photo(photo: schemas.PhotoCreate, db: Session = Depends(get_db)):
     return crud.photo.create(db=db, obj_in=photo)
 
 @app.get("/api/v1/photos/", response_model=List[schemas.PhotoResponse])
-def read_photos(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    photos = crud.photo.get_multi(db, skip=skip, limit=limit)
-    return photos
+def read_photos(
+    skip: int = 0,
+    limit: int = 100,
+    filters: schemas.MediaFilter = Depends(),
+    db: Session = Depends(get_db)
+):
+    return list_filtered(crud.photo, db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/api/v1/photos", response_model=schemas.PhotoManyResponse)
+def read_photos_by_ids(request: Request, ids: Optional[str] = Query(None, description="Comma-separated ids"),
+                 db: Session = Depends(get_db)):
+    return read_many(crud.photo, request, ids, db)
 
 @app.get("/api/v1/photos/{photo_id}", response_model=schemas.PhotoResponse)
 def read_photo(photo_id: int, db: Session = Depends(get_db)):
@@ -53,28 +151,57 @@ def read_photo(photo_id: int, db: Session = Depends(get_db)):
 
 @app.put("/api/v1/photos/{photo_id}", response_model=schemas.PhotoResponse)
 def update_photo(photo_id: int, photo: schemas.PhotoUpdate, db: Session = Depends(get_db)):
-    db_photo = crud.photo.get(db, id=photo_id)
+    db_photo = crud.photo.update(db, id=photo_id, obj_in=photo)
     if db_photo is None:
         raise HTTPException(status_code=404, detail="Photo not found")
-    return crud.photo.update(db, db_obj=db_photo, obj_in=photo)
+    return db_photo
 
 @app.delete("/api/v1/photos/{photo_id}")
 def delete_photo(photo_id: int, db: Session = Depends(get_db)):
-    db_photo = crud.photo.get(db, id=photo_id)
-    if db_photo is None:
+    if crud.photo.delete(db, id=photo_id) is None:
         raise HTTPException(status_code=404, detail="Photo not found")
-    crud.photo.delete(db, id=photo_id)
     return {"message": "Photo deleted successfully"}
 
+@app.get("/api/v1/photos/{photo_id}/similar", response_model=List[schemas.SimilarPhotoResponse])
+def read_similar_photos(
+    photo_id: int,
+    max_distance: int = Query(10, ge=0, le=64, description="Maximum Hamming distance between hashes"),
+    algorithm: str = Query("phash", pattern="^(phash|dhash)$", description="Hash to compare"),
+    limit: int = Query(20, ge=1, le=200, description="Number of results"),
+    db: Session = Depends(get_db)
+):
+    if not similarity.index.ready:
+        raise HTTPException(status_code=503, detail="Similarity index is loading, retry shortly")
+    value = similarity.index.get(photo_id, algorithm)
+    if value is None:
+        if crud.photo.get(db, id=photo_id) is None:
+            raise HTTPException(status_code=404, detail="Photo not found")
+        raise HTTPException(status_code=404, detail="Photo has no fingerprint")
+    matches = similarity.index.search(value, max_distance, limit=limit, algorithm=algorithm, exclude_id=photo_id)
+    photos = {p.id: p for p in db.query(models.Photo).filter(models.Photo.id.in_([m[0] for m in matches]))}
+    return [
+        {"photo": photos[match_id], "distance": distance}
+        for match_id, distance in matches if match_id in photos
+    ]
+
 # Video endpoints
 @app.post("/api/v1/videos/", response_model=schemas.VideoResponse)
 def create_video(video: schemas.VideoCreate, db: Session = Depends(get_db)):
     return crud.video.create(db=db, obj_in=video)
 
 @app.get("/api/v1/videos/", response_model=List[schemas.VideoResponse])
-def read_videos(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    videos = crud.video.get_multi(db, skip=skip, limit=limit)
-    return videos
+def read_videos(
+    skip: int = 0,
+    limit: int = 100,
+    filters: schemas.MediaFilter = Depends(),
+    db: Session = Depends(get_db)
+):
+    return list_filtered(crud.video, db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/api/v1/videos", response_model=schemas.VideoManyResponse)
+def read_videos_by_ids(request: Request, ids: Optional[str] = Query(None, description="Comma-separated ids"),
+                 db: Session = Depends(get_db)):
+    return read_many(crud.video, request, ids, db)
 
 @app.get("/api/v1/videos/{video_id}", response_model=schemas.VideoResponse)
 def read_video(video_id: int, db: Session = Depends(get_db)):
@@ -85,17 +212,15 @@ def read_video(video_id: int, db: Session = Depends(get_db)):
 
 @app.put("/api/v1/videos/{video_id}", response_model=schemas.VideoResponse)
 def update_video(video_id: int, video: schemas.VideoUpdate, db: Session = Depends(get_db)):
-    db_video = crud.video.get(db, id=video_id)
+    db_video = crud.video.update(db, id=video_id, obj_in=video)
     if db_video is None:
         raise HTTPException(status_code=404, detail="Video not found")
-    return crud.video.update(db, db_obj=db_video, obj_in=video)
+    return db_video
 
 @app.delete("/api/v1/videos/{video_id}")
 def delete_video(video_id: int, db: Session = Depends(get_db)):
-    db_video = crud.video.get(db, id=video_id)
-    if db_video is None:
+    if crud.video.delete(db, id=video_id) is None:
         raise HTTPException(status_code=404, detail="Video not found")
-    crud.video.delete(db, id=video_id)
     return {"message": "Video deleted successfully"}
 
 # Book endpoints
@@ -104,9 +229,18 @@ def create_book(book: schemas.BookCreate, db: Session = Depends(get_db)):
     return crud.book.create(db=db, obj_in=book)
 
 @app.get("/api/v1/books/", response_model=List[schemas.BookResponse])
-def read_books(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    books = crud.book.get_multi(db, skip=skip, limit=limit)
-    return books
+def read_books(
+    skip: int = 0,
+    limit: int = 100,
+    filters: schemas.MediaFilter = Depends(),
+    db: Session = Depends(get_db)
+):
+    return list_filtered(crud.book, db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/api/v1/books", response_model=schemas.BookManyResponse)
+def read_books_by_ids(request: Request, ids: Optional[str] = Query(None, description="Comma-separated ids"),
+                 db: Session = Depends(get_db)):
+    return read_many(crud.book, request, ids, db)
 
 @app.get("/api/v1/books/{book_id}", response_model=schemas.BookResponse)
 def read_book(book_id: int, db: Session = Depends(get_db)):
@@ -117,17 +251,15 @@ def read_book(book_id: int, db: Session = Depends(get_db)):
 
 @app.put("/api/v1/books/{book_id}", response_model=schemas.BookResponse)
 def update_book(book_id: int, book: schemas.BookUpdate, db: Session = Depends(get_db)):
-    db_book = crud.book.get(db, id=book_id)
+    db_book = crud.book.update(db, id=book_id, obj_in=book)
     if db_book is None:
         raise HTTPException(status_code=404, detail="Book not found")
-    return crud.book.update(db, db_obj=db_book, obj_in=book)
+    return db_book
 
 @app.delete("/api/v1/books/{book_id}")
 def delete_book(book_id: int, db: Session = Depends(get_db)):
-    db_book = crud.book.get(db, id=book_id)
-    if db_book is None:
+    if crud.book.delete(db, id=book_id) is None:
         raise HTTPException(status_code=404, detail="Book not found")
-    crud.book.delete(db, id=book_id)
     return {"message": "Book deleted successfully"}
 
 # UserDocument endpoints
@@ -136,9 +268,18 @@ def create_document(document: schemas.UserDocumentCreate, db: Session = Depends(
     return crud.user_document.create(db=db, obj_in=document)
 
 @app.get("/api/v1/documents/", response_model=List[schemas.UserDocumentResponse])
-def read_documents(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    documents = crud.user_document.get_multi(db, skip=skip, limit=limit)
-    return documents
+def read_documents(
+    skip: int = 0,
+    limit: int = 100,
+    filters: schemas.MediaFilter = Depends(),
+    db: Session = Depends(get_db)
+):
+    return list_filtered(crud.user_document, db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/api/v1/documents", response_model=schemas.UserDocumentManyResponse)
+def read_documents_by_ids(request: Request, ids: Optional[str] = Query(None, description="Comma-separated ids"),
+                 db: Session = Depends(get_db)):
+    return read_many(crud.user_document, request, ids, db)
 
 @app.get("/api/v1/documents/{document_id}", response_model=schemas.UserDocumentResponse)
 def read_document(document_id: int, db: Session = Depends(get_db)):
@@ -149,17 +290,15 @@ def read_document(document_id: int, db: Session = Depends(get_db)):
 
 @app.put("/api/v1/documents/{document_id}", response_model=schemas.UserDocumentResponse)
 def update_document(document_id: int, document: schemas.UserDocumentUpdate, db: Session = Depends(get_db)):
-    db_document = crud.user_document.get(db, id=document_id)
+    db_document = crud.user_document.update(db, id=document_id, obj_in=document)
     if db_document is None:
         raise HTTPException(status_code=404, detail="Document not found")
-    return crud.user_document.update(db, db_obj=db_document, obj_in=document)
+    return db_document
 
 @app.delete("/api/v1/documents/{document_id}")
 def delete_document(document_id: int, db: Session = Depends(get_db)):
-    db_document = crud.user_document.get(db, id=document_id)
-    if db_document is None:
+    if crud.user_document.delete(db, id=document_id) is None:
         raise HTTPException(status_code=404, detail="Document not found")
-    crud.user_document.delete(db, id=document_id)
     return {"message": "Document deleted successfully"}
 
 # Character endpoints
@@ -168,9 +307,18 @@ def create_character(character: schemas.CharacterCreate, db: Session = Depends(g
     return crud.character.create(db=db, obj_in=character)
 
 @app.get("/api/v1/characters/", response_model=List[schemas.CharacterResponse])
-def read_characters(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    characters = crud.character.get_multi(db, skip=skip, limit=limit)
-    return characters
+def read_characters(
+    skip: int = 0,
+    limit: int = 100,
+    filters: schemas.MediaFilter = Depends(),
+    db: Session = Depends(get_db)
+):
+    return list_filtered(crud.character, db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/api/v1/characters", response_model=schemas.CharacterManyResponse)
+def read_characters_by_ids(request: Request, ids: Optional[str] = Query(None, description="Comma-separated ids"),
+                 db: Session = Depends(get_db)):
+    return read_many(crud.character, request, ids, db)
 
 @app.get("/api/v1/characters/{character_id}", response_model=schemas.CharacterResponse)
 def read_character(character_id: int, db: Session = Depends(get_db)):
@@ -181,17 +329,15 @@ def read_character(character_id: int, db: Session = Depends(get_db)):
 
 @app.put("/api/v1/characters/{character_id}", response_model=schemas.CharacterResponse)
 def update_character(character_id: int, character: schemas.CharacterUpdate, db: Session = Depends(get_db)):
-    db_character = crud.character.get(db, id=character_id)
+    db_character = crud.character.update(db, id=character_id, obj_in=character)
     if db_character is None:
         raise HTTPException(status_code=404, detail="Character not found")
-    return crud.character.update(db, db_obj=db_character, obj_in=character)
+    return db_character
 
 @app.delete("/api/v1/characters/{character_id}")
 def delete_character(character_id: int, db: Session = Depends(get_db)):
-    db_character = crud.character.get(db, id=character_id)
-    if db_character is None:
+    if crud.character.delete(db, id=character_id) is None:
         raise HTTPException(status_code=404, detail="Character not found")
-    crud.character.delete(db, id=character_id)
     return {"message": "Character deleted successfully"}
 
 # Character media management endpoints
@@ -216,6 +362,45 @@ def add_book_to_character(character_id: int, book_id: int, db: Session = Depends
         raise HTTPException(status_code=404, detail="Character or Book not found")
     return {"message": "Book added to character successfully"}
 
+# Recommendation endpoints (served from the cached co-occurrence matrix)
+@app.get("/api/v1/characters/{character_id}/related", response_model=List[schemas.RelatedCharacter])
+def read_related_characters(
+    character_id: int,
+    limit: int = Query(10, ge=1, le=100, description="Number of results"),
+    db: Session = Depends(get_db)
+):
+    if crud.character.get(db, id=character_id) is None:
+        raise HTTPException(status_code=404, detail="Character not found")
+    scores = related.graph.related_characters(character_id, limit=limit)
+    characters = {c.id: c for c in db.query(models.Character).filter(models.Character.id.in_([s[0] for s in scores]))}
+    return [
+        {"character": characters[other_id], "shared_media": shared}
+        for other_id, shared in scores if other_id in characters
+    ]
+
+@app.get("/api/v1/{collection}/{media_id}/related", response_model=List[schemas.RelatedMedia])
+def read_related_media(
+    collection: schemas.MediaCollection,
+    media_id: int,
+    limit: int = Query(10, ge=1, le=100, description="Number of results"),
+    db: Session = Depends(get_db)
+):
+    media_type = collection.value[:-1]
+    if crud.media_by_type[media_type].get(db, id=media_id) is None:
+        raise HTTPException(status_code=404, detail=f"{media_type.capitalize()} not found")
+    scores = related.graph.related_media(media_type, media_id, limit=limit)
+    found = {}
+    for other_type in {key[0] for key, _ in scores}:
+        model = crud.media_by_type[other_type].model
+        ids = [key[1] for key, _ in scores if key[0] == other_type]
+        for item in db.query(model).filter(model.id.in_(ids)):
+            found[(other_type, item.id)] = item
+    return [
+        {"media_type": key[0], "id": key[1], "title": found[key].title,
+         "file_path": found[key].file_path, "shared_characters": shared}
+        for key, shared in scores if key in found
+    ]
+
 # Review endpoints
 @app.post("/api/v1/reviews/", response_model=schemas.ReviewResponse)
 def create_review(review: schemas.ReviewCreate, db: Session = Depends(get_db)):
@@ -225,9 +410,18 @@ def create_review(review: schemas.ReviewCreate, db: Session = Depends(get_db)):
     return crud.review.create(db=db, obj_in=review)
 
 @app.get("/api/v1/reviews/", response_model=List[schemas.ReviewResponse])
-def read_reviews(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    reviews = crud.review.get_multi(db, skip=skip, limit=limit)
-    return reviews
+def read_reviews(
+    skip: int = 0,
+    limit: int = 100,
+    filters: schemas.MediaFilter = Depends(),
+    db: Session = Depends(get_db)
+):
+    return list_filtered(crud.review, db, skip=skip, limit=limit, filters=filters)
+
+@app.get("/api/v1/reviews", response_model=schemas.ReviewManyResponse)
+def read_reviews_by_ids(request: Request, ids: Optional[str] = Query(None, description="Comma-separated ids"),
+                 db: Session = Depends(get_db)):
+    return read_many(crud.review, request, ids, db)
 
 @app.get("/api/v1/reviews/{review_id}", response_model=schemas.ReviewResponse)
 def read_review(review_id: int, db: Session = Depends(get_db)):
@@ -238,74 +432,103 @@ def read_review(review_id: int, db: Session = Depends(get_db)):
 
 @app.put("/api/v1/reviews/{review_id}", response_model=schemas.ReviewResponse)
 def update_review(review_id: int, review: schemas.ReviewUpdate, db: Session = Depends(get_db)):
-    db_review = crud.review.get(db, id=review_id)
-    if db_review is None:
-        raise HTTPException(status_code=404, detail="Review not found")
-    
     # Check the rating if it is provided
+    if "rating" in review.model_fields_set and review.rating is None:
+        raise HTTPException(status_code=400, detail="Rating cannot be null")
     if review.rating is not None and (review.rating < 1 or review.rating > 10):
         raise HTTPException(status_code=400, detail="Rating must be between 1 and 10")
     
-    return crud.review.update(db, db_obj=db_review, obj_in=review)
+    db_review = crud.review.update(db, id=review_id, obj_in=review)
+    if db_review is None:
+        raise HTTPException(status_code=404, detail="Review not found")
+    return db_review
 
 @app.delete("/api/v1/reviews/{review_id}")
 def delete_review(review_id: int, db: Session = Depends(get_db)):
-    db_review = crud.review.get(db, id=review_id)
-    if db_review is None:
+    if crud.review.delete(db, id=review_id) is None:
         raise HTTPException(status_code=404, detail="Review not found")
-    crud.review.delete(db, id=review_id)
     return {"message": "Review deleted successfully"}
 
-# File upload endpoint
-@app.post("/api/v1/upload/")
-async def upload_file(
-    file: UploadFile = File(...),
-    media_type: str = Form(...),
-    title: str = Form(...),
-    description: Optional[str] = Form(None),
+# Batch endpoint: several API calls in one HTTP round trip, answered in request order
+@app.post("/api/v1/batch", response_model=schemas.BatchResponse)
+async def run_batch(request: schemas.BatchRequest):
+    if len(request.requests) > batch.MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {batch.MAX_BATCH_SIZE} requests per batch")
+    if any(urlsplit(item.path).path.rstrip("/") == batch.BATCH_PATH for item in request.requests):
+        raise HTTPException(status_code=400, detail="Batches cannot be nested")
+    return {"responses": await batch.execute(app, request.requests)}
+
+# Cross-type multi-get for mixed feeds (e.g. the media of a page of reviews)
+@app.get("/api/v1/media", response_model=schemas.MediaManyResponse)
+def read_media_by_refs(
+    ids: str = Query(..., description="Comma-separated type:id pairs, e.g. photo:1,book:7"),
     db: Session = Depends(get_db)
 ):
-    # Generate a unique file name
-    file_extension = os.path.splitext(file.filename)[1]
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{media_type}_{timestamp}{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    # Save file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # Get the file size
-    file_size = os.path.getsize(file_path)
-    
-    # Create a database entry based on the media type
+    refs = []
+    for item in parse_id_list(ids):
+        media_type, _, media_id = item.partition(":")
+        if media_type not in crud.media_by_type or not media_id.isdigit():
+            raise HTTPException(status_code=400, detail=f"Invalid media reference '{item}'")
+        refs.append((media_type, int(media_id)))
+    items = crud.get_media_many(db, refs)
+    return {
+        "items": [
+            {"media_type": media_type, "id": media_id,
+             "item": MEDIA_RESPONSE_SCHEMAS[media_type].model_validate(item) if item is not None else None}
+            for (media_type, media_id), item in zip(refs, items)
+        ],
+        "missing": [f"{media_type}:{media_id}" for (media_type, media_id), item in zip(refs, items) if item is None],
+    }
+
+# Rankings endpoint (served from review rollups, never scans raw reviews)
+@app.get("/api/v1/rankings", response_model=schemas.RankingResponse)
+def get_rankings(
+    type: schemas.MediaType = Query(..., description="Media type to rank"),
+    window: str = Query("7d", pattern=r"^\d{1,3}d$", description="Time window in days, e.g. 7d"),
+    by: schemas.RankingMetric = Query(schemas.RankingMetric.AVG, description="Ranking metric"),
+    limit: int = Query(50, ge=1, le=200, description="Number of results"),
+    db: Session = Depends(get_db)
+):
+    window_days = int(window[:-1])
+    # Older buckets are merged into months, which a day-based window would cut through
+    max_days = crud.review_rollup.daily_retention_days
+    if not 1 <= window_days <= max_days:
+        raise HTTPException(status_code=400, detail=f"Window must be between 1d and {max_days}d")
+    results = crud.review_rollup.rank(db, media_type=type, window_days=window_days, by=by, limit=limit)
+    return {"media_type": type, "window_days": window_days, "by": by, "results": results}
+
+def media_create_schema(media_type: str, title: str, description: Optional[str], file_path: str,
+                        file_size: int, content_type: Optional[str], file_extension: str) -> schemas.BaseModel:
+    """Validated create schema of the Photo/Video/Book/UserDocument row for an upload
+
+    Built before the file is moved into the store; the stored path is filled
+    in with create_media_record().
+    """
     if media_type == "photo":
-        photo_data = schemas.PhotoCreate(
+        return schemas.PhotoCreate(
             title=title,
             description=description,
             file_path=file_path,
             file_size=file_size,
-            file_type=file.content_type,
+            file_type=content_type,
             width=0,  # You can add image processing to get the dimensions
             height=0
         )
-        return crud.photo.create(db=db, obj_in=photo_data)
     
     elif media_type == "video":
-        video_data = schemas.VideoCreate(
+        return schemas.VideoCreate(
             title=title,
             description=description,
             file_path=file_path,
             file_size=file_size,
-            file_type=file.content_type,
+            file_type=content_type,
             width=0,
             height=0,
             duration=0  # You can add video processing to get the duration
         )
-        return crud.video.create(db=db, obj_in=video_data)
     
     elif media_type == "book":
-        book_data = schemas.BookCreate(
+        return schemas.BookCreate(
             title=title,
             author="Unknown",  # You can add an author field to the form
             description=description,
@@ -314,21 +537,138 @@ async def upload_file(
             file_format=file_extension[1:].upper(),  # PDF, EPUB, etc.
             page_count=None
         )
-        return crud.book.create(db=db, obj_in=book_data)
     
     elif media_type == "document":
-        document_data = schemas.UserDocumentCreate(
+        return schemas.UserDocumentCreate(
             title=title,
             description=description,
             file_path=file_path,
             file_size=file_size,
             review=description  # You can use the description as a review
         )
-        return crud.user_document.create(db=db, obj_in=document_data)
     
     else:
         raise HTTPException(status_code=400, detail="Unsupported media type")
 
+def create_media_record(db: Session, media_type: str, media_data: schemas.BaseModel, file_path: str):
+    """Create the row for a stored upload from media_create_schema() with its stored path"""
+    media_data = media_data.model_copy(update={"file_path": file_path})
+    return crud.media_by_type[media_type].create(db=db, obj_in=media_data)
+
+# File upload endpoint
+@app.post("/api/v1/upload/")
+async def upload_file(
+    file: UploadFile = File(...),
+    media_type: str = Form(...),
+    title: str = Form(...),
+    description: Optional[str] = Form(None),
+    db: Session = Depends(get_db)
+):
+    if media_type not in crud.media_by_type:
+        raise HTTPException(status_code=400, detail="Unsupported media type")
+    
+    # Save file into the content-addressed store (identical uploads share one blob)
+    file_extension = os.path.splitext(file.filename)[1]
+    tmp_path, digest, file_size = await run_in_threadpool(storage.blobs.spool, file.file)
+    
+    # Blob and database entry (which takes the blob reference) are committed together
+    def store(wdb: Session):
+        file_path, _ = storage.blobs.store_file(wdb, tmp_path, file_extension, digest)
+        return create_media_record(wdb, media_type, media_data, file_path)
+    try:
+        media_data = media_create_schema(
+            media_type, title, description, storage.blobs.blob_path(digest, file_extension), file_size,
+            file.content_type or storage.guess_content_type(file.filename), file_extension
+        )
+        return await run_in_threadpool(writer.queue.execute, db, store)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Resumable upload endpoints: create a session, PUT chunks at any offset
+# (in any order, in parallel), check progress, then complete
+@app.post("/api/v1/uploads/", response_model=schemas.UploadSessionResponse)
+def create_upload_session(upload: schemas.UploadSessionCreate, db: Session = Depends(get_db)):
+    if upload.total_size > resumable.MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail=f"Files are limited to {resumable.MAX_FILE_SIZE} bytes")
+    return resumable.progress(db, resumable.create_session(db, upload))
+
+def get_upload_session(db: Session, upload_id: str) -> models.UploadSession:
+    session = resumable.get_session(db, upload_id)
+    if session is None:
+        if resumable.is_completed(db, upload_id):
+            raise HTTPException(status_code=409, detail="Upload already completed")
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+@app.put("/api/v1/uploads/{upload_id}", response_model=schemas.UploadSessionResponse)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="Byte offset of the chunk in the file"),
+    db: Session = Depends(get_db)
+):
+    body = await request.body()
+    if not body:
+        raise HTTPException(status_code=400, detail="Empty chunk")
+    if len(body) > resumable.MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f"Chunks are limited to {resumable.MAX_CHUNK_SIZE} bytes")
+
+    def write():
+        session = get_upload_session(db, upload_id)
+        if offset + len(body) > session.total_size:
+            raise HTTPException(status_code=400, detail="Chunk exceeds the declared file size")
+        if not resumable.write_chunk(db, session, offset, body):
+            raise HTTPException(status_code=409, detail="Upload already completed or cancelled")
+        return resumable.progress(db, session)
+
+    return await run_in_threadpool(write)
+
+@app.get("/api/v1/uploads/{upload_id}", response_model=schemas.UploadSessionResponse)
+def read_upload_session(upload_id: str, db: Session = Depends(get_db)):
+    return resumable.progress(db, get_upload_session(db, upload_id))
+
+@app.post("/api/v1/uploads/{upload_id}/complete")
+def complete_upload(upload_id: str, db: Session = Depends(get_db)):
+    session = get_upload_session(db, upload_id)
+    # Chunks still being written are waited for and later ones refused
+    resumable.close_writes(upload_id)
+    try:
+        return complete_upload_session(db, session)
+    finally:
+        resumable.open_writes(upload_id)
+
+def complete_upload_session(db: Session, session: models.UploadSession):
+    if resumable.progress(db, session)["missing"]:
+        raise HTTPException(status_code=409, detail="Upload is incomplete")
+    file_extension = os.path.splitext(session.filename)[1]
+    media_type = session.media_type
+    # Hashing and validation happen before the write operation, which only moves the file
+    try:
+        digest = storage.blobs.hash_file(resumable.part_path(session.id))
+    except FileNotFoundError:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    media_data = media_create_schema(
+        media_type, session.title, session.description, storage.blobs.blob_path(digest, file_extension),
+        session.total_size, session.content_type or storage.guess_content_type(session.filename), file_extension
+    )
+
+    def complete(wdb: Session):
+        stored = resumable.finish(wdb, session, digest)
+        if stored is None:
+            return None
+        file_path, _ = stored
+        return create_media_record(wdb, media_type, media_data, file_path)
+    record = writer.queue.execute(db, complete)
+    if record is None:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    return record
+
+@app.delete("/api/v1/uploads/{upload_id}")
+def cancel_upload(upload_id: str, db: Session = Depends(get_db)):
+    resumable.discard(db, get_upload_session(db, upload_id))
+    return {"message": "Upload cancelled successfully"}
+
 # File download endpoint
 @app.get("/api/v1/files/{file_path:path}")
 async def download_file(file_path: str):
@@ -345,6 +685,53 @@ def search_media(
 ):
     return crud.search_media(db, query=q, limit=limit)
 
+# Change feed: clients keep the returned cursor and fetch only what changed since
+@app.get("/api/v1/changes", response_model=schemas.ChangeFeedResponse)
+def read_changes(
+    since: Optional[int] = Query(None, ge=0, description="Cursor from the previous response; omit to get the current cursor"),
+    limit: int = Query(500, ge=1, le=5000, description="Maximum number of changes"),
+    db: Session = Depends(get_db)
+):
+    if since is None:
+        return {"changes": [], "cursor": crud.change_log.latest(db), "has_more": False}
+    entries = crud.change_log.since(db, cursor=since, limit=limit)
+    if entries is None:
+        raise HTTPException(status_code=410, detail="Cursor has expired, re-list the collections and start again")
+    changes = [
+        {"cursor": entry.id, "entity": entry.entity, "id": entry.entity_id, "op": entry.op,
+         "related_type": entry.related_type, "related_id": entry.related_id, "changed_at": entry.changed_at}
+        for entry in entries
+    ]
+    return {"changes": changes, "cursor": entries[-1].id if entries else since, "has_more": len(entries) == limit}
+
+# Full-text search inside book and document files (extracted in the background by content.py)
+@app.get("/api/v1/search/content", response_model=List[schemas.ContentSearchHit])
+def search_content(
+    q: str = Query(..., min_length=1, description="Words to find in the file contents"),
+    type: Optional[str] = Query(None, pattern="^(book|document)$", description="Restrict to books or documents"),
+    limit: int = Query(20, ge=1, le=100, description="Number of results"),
+    db: Session = Depends(get_db)
+):
+    hits = content.search(db, q, media_type=type, limit=limit)
+    media = crud.get_media_many(db, [(hit["media_type"], hit["id"]) for hit in hits])
+    return [{**hit, "title": item.title} for hit, item in zip(hits, media) if item is not None]
+
+# Autocomplete endpoint (in-memory prefix index, no database access once it is built)
+@app.get("/api/v1/autocomplete", response_model=List[schemas.AutocompleteItem])
+def autocomplete_titles(
+    q: str = Query(..., min_length=1, description="Prefix typed so far"),
+    types: Optional[str] = Query(None, description="Comma-separated subset of: " + ", ".join(autocomplete.KINDS)),
+    limit: int = Query(10, ge=1, le=50, description="Number of suggestions"),
+    db: Session = Depends(get_db)
+):
+    kinds = [kind.strip() for kind in types.split(",") if kind.strip()] if types else list(autocomplete.KINDS)
+    unknown = set(kinds) - set(autocomplete.KINDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown type(s): {', '.join(sorted(unknown))}")
+    if not autocomplete.index.ready:
+        return autocomplete.complete_from_db(db, q, kinds, limit)
+    return autocomplete.index.complete(q, kinds, limit)
+
 # Additional search endpoints
 @app.get("/api/v1/photos/search/")
 def search_photos(
@@ -389,6 +776,32 @@ def get_statistics(db: Session = Depends(get_db)):
         "reviews": review_count
     }
 
+# Group-commit writer metrics: queue depth, batch sizes, commit latency
+@app.get("/api/v1/stats/writes")
+def get_write_statistics():
+    return writer.queue.metrics()
+
+# Admin: stored request profiles (see profiling.py; needs the X-Admin-Token header)
+@app.get("/api/v1/admin/profiles", dependencies=[Depends(profiling.require_admin)])
+def list_profiles():
+    return profiling.store.list()
+
+@app.get("/api/v1/admin/profiles/{profile_id}", dependencies=[Depends(profiling.require_admin)])
+def read_profile(profile_id: str):
+    profile = profiling.store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+@app.get("/api/v1/admin/profiles/{profile_id}/collapsed", response_class=PlainTextResponse,
+         dependencies=[Depends(profiling.require_admin)])
+def read_profile_collapsed(profile_id: str):
+    """Collapsed stacks, e.g. `flamegraph.pl profile.txt > profile.svg` or open in speedscope"""
+    profile = profiling.store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profiling.collapsed(profile)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
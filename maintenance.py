@@ -0,0 +1,96 @@
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import crud
+import writer
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Free pages returned to the OS per run by incremental vacuum (0 = all)
+VACUUM_PAGES = 2000
+# Rows sampled per index by ANALYZE, so it stays short on a large database
+ANALYSIS_LIMIT = 1000
+
+def delete_orphan_reviews(db: Session, batch_size: int = crud.COMPACT_BATCH_SIZE) -> int:
+    """Delete reviews, review rollups and averages whose media object no longer exists"""
+    total = 0
+    for media_type, crud_obj in crud.media_by_type.items():
+        table = crud_obj.model.__tablename__
+        for source in ("reviews", "review_rollups", "media_ratings"):
+            # Deleted reviews get a tombstone in the change log
+            returning, record = ("RETURNING id", _record_review_deletes) if source == "reviews" else ("", None)
+            total += crud.delete_in_batches(db, f"""
+                DELETE FROM {source} WHERE rowid IN (
+                    SELECT r.rowid FROM {source} r
+                    WHERE r.media_type = :media_type
+                      AND NOT EXISTS (SELECT 1 FROM {table} m WHERE m.id = r.media_id)
+                    LIMIT :batch
+                ) {returning}
+            """, {"media_type": media_type}, batch_size, record)
+    return total
+
+def _record_review_deletes(db: Session, rows: list) -> None:
+    for (review_id,) in rows:
+        crud.change_log.record(db, "review", review_id, "delete")
+
+def delete_orphan_links(db: Session, batch_size: int = crud.COMPACT_BATCH_SIZE) -> int:
+    """Delete character association rows pointing at a missing character or media object"""
+    total = 0
+    for crud_obj in (crud.photo, crud.video, crud.book):
+        for link_table, column in crud_obj.link_tables:
+            if "character_id" not in link_table.c:
+                continue
+            table = crud_obj.model.__tablename__
+            total += crud.delete_in_batches(db, f"""
+                DELETE FROM {link_table.name} WHERE rowid IN (
+                    SELECT l.rowid FROM {link_table.name} l
+                    WHERE NOT EXISTS (SELECT 1 FROM characters c WHERE c.id = l.character_id)
+                       OR NOT EXISTS (SELECT 1 FROM {table} m WHERE m.id = l.{column})
+                    LIMIT :batch
+                ) RETURNING character_id, {column}
+            """, {}, batch_size, _link_recorder(crud_obj.media_type))
+    return total
+
+def _link_recorder(media_type: str):
+    def record(db: Session, rows: list) -> None:
+        for character_id, media_id in rows:
+            crud.change_log.record(db, "character", character_id, "unlink", media_type, media_id)
+    return record
+
+def reclaim_space(db: Session) -> None:
+    """Refresh planner statistics and return free pages to the filesystem"""
+    writer.queue.execute(db, _analyze, attach=False)
+    writer.queue.execute(db, _incremental_vacuum, attach=False)
+
+def _analyze(db: Session) -> None:
+    connection = db.connection()
+    connection.exec_driver_sql(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    connection.exec_driver_sql("ANALYZE")
+
+def _incremental_vacuum(db: Session) -> None:
+    # No-op unless the database uses auto_vacuum = INCREMENTAL (set up by init_db.py).
+    # The pragma frees one page per step and sqlite3's execute() steps only once,
+    # so each execute frees one page; executescript() would commit the writer's transaction.
+    connection = db.connection()
+    free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    for _ in range(free_pages if VACUUM_PAGES == 0 else min(free_pages, VACUUM_PAGES)):
+        connection.exec_driver_sql("PRAGMA incremental_vacuum")
+
+def compact_orphans(db: Session, batch_size: int = crud.COMPACT_BATCH_SIZE) -> dict:
+    reviews = delete_orphan_reviews(db, batch_size)
+    links = delete_orphan_links(db, batch_size)
+    if reviews or links:
+        reclaim_space(db)
+    return {"reviews": reviews, "links": links}
+
+if __name__ == "__main__":
+    session = SessionLocal()
+    try:
+        result = compact_orphans(session)
+        reclaim_space(session)
+        print(f"Removed {result['reviews']} orphaned reviews/rollups and {result['links']} orphaned links")
+    finally:
+        session.close()
@@ -0,0 +1,80 @@
+import os
+import shutil
+
+from sqlalchemy.orm import Session
+
+import crud
+import storage
+from database import SessionLocal
+from models import Blob
+
+# Media rows updated per transaction
+BATCH_SIZE = 200
+
+def _link(src_path: str, blob_path: str) -> None:
+    """Give the legacy file its blob name too; the legacy name is removed after the commit"""
+    if os.path.exists(blob_path):
+        return
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    try:
+        os.link(src_path, blob_path)
+    except OSError:
+        # No hard links here (e.g. another filesystem)
+        shutil.copyfile(src_path, blob_path)
+
+def migrate_legacy_files(db: Session, batch_size: int = BATCH_SIZE) -> dict:
+    """Move files named {media_type}_{timestamp}{ext} into the content-addressed layout
+
+    Rows whose file is already a blob, or whose file is missing on disk, are left as is.
+    Files are hard-linked under their blob name before a batch commits and lose their
+    legacy name only once all rows are migrated. An interrupted run never leaves
+    rows pointing at files that were moved away, at worst legacy copies of
+    files whose rows were already migrated; it can simply be run again.
+    Identical files collapse into one blob.
+    """
+    stats = {"migrated": 0, "deduplicated": 0, "missing": 0}
+    # Legacy path -> blob path, for legacy files shared by several rows
+    moved = {}
+    for crud_obj in crud.media_by_type.values():
+        model = crud_obj.model
+        last_id = 0
+        while True:
+            rows = db.query(model).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                last_id = row.id
+                path = row.file_path
+                if not path or storage.blobs.digest_of(path):
+                    continue
+                if path not in moved:
+                    if not os.path.isfile(path):
+                        stats["missing"] += 1
+                        continue
+                    digest = storage.blobs.hash_file(path)
+                    blob = db.get(Blob, digest)
+                    if blob is not None:
+                        stats["deduplicated"] += 1
+                        moved[path] = blob.file_path
+                    else:
+                        moved[path] = storage.blobs.blob_path(digest, os.path.splitext(path)[1])
+                    _link(path, moved[path])
+                row.file_path = moved[path]
+                db.flush()
+                storage.blobs.acquire(db, row.file_path)
+                stats["migrated"] += 1
+            db.commit()
+
+    for path, blob_path in moved.items():
+        if os.path.exists(path) and os.path.abspath(path) != os.path.abspath(blob_path):
+            os.remove(path)
+    return stats
+
+if __name__ == "__main__":
+    session = SessionLocal()
+    try:
+        result = migrate_legacy_files(session)
+        print(f"Migrated {result['migrated']} files "
+              f"({result['deduplicated']} duplicates merged, {result['missing']} missing on disk)")
+    finally:
+        session.close()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, Text, Float, Date, DateTime, ForeignKey, Index, Table
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -101,4 +101,118 @@ class Review(Base):
     media_id = Column(Integer)   # ID of the entity of the specified type
     rating = Column(Integer)     # Rating from 1 to 10
     comment = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ReviewRollup(Base):
+    """Per-day review aggregates of one media object, maintained on every review write"""
+    __tablename__ = "review_rollups"
+    
+    # Key order lets a ranking window scan only the buckets of one media type
+    media_type = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)  # Buckets older than the retention are merged into the 1st of the month
+    media_id = Column(Integer, primary_key=True)
+    review_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+
+class MediaRating(Base):
+    """Review count and average rating of one media object, maintained with the rollups"""
+    __tablename__ = "media_ratings"
+    
+    media_type = Column(String, primary_key=True)
+    media_id = Column(Integer, primary_key=True)
+    review_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    average_rating = Column(Float, nullable=True)  # NULL once the last review is gone
+    
+    # Serves the min_rating/max_rating filters of the media list endpoints
+    __table_args__ = (Index("idx_media_rating_average", "media_type", "average_rating"),)
+
+class Blob(Base):
+    """Uploaded file stored once per content hash, shared by all media rows pointing at it"""
+    __tablename__ = "blobs"
+    
+    sha256 = Column(String, primary_key=True)
+    file_path = Column(String, nullable=False)
+    file_size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+
+
+class UploadSession(Base):
+    """Resumable upload in progress; chunks are written into a preallocated file"""
+    __tablename__ = "upload_sessions"
+    
+    id = Column(String, primary_key=True)
+    media_type = Column(String, nullable=False)
+    title = Column(String, nullable=False)
+    description = Column(Text, nullable=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=True)
+    total_size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class UploadChunk(Base):
+    __tablename__ = "upload_chunks"
+    
+    session_id = Column(String, ForeignKey('upload_sessions.id'), primary_key=True)
+    offset = Column(Integer, primary_key=True)
+    length = Column(Integer, nullable=False)
+
+class CompletedUpload(Base):
+    """Tombstone of a completed upload session, so late chunks and completions get a 409"""
+    __tablename__ = "completed_uploads"
+    
+    id = Column(String, primary_key=True)
+    completed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class PhotoHash(Base):
+    """Perceptual fingerprints of a photo (64-bit hashes stored as signed integers)"""
+    __tablename__ = "photo_hashes"
+    
+    photo_id = Column(Integer, ForeignKey('photos.id'), primary_key=True)
+    phash = Column(Integer, nullable=False)
+    dhash = Column(Integer, nullable=False)
+
+
+class ChangeLog(Base):
+    """One row per committed write, read by clients syncing with /api/v1/changes
+
+    The id is the sync cursor: AUTOINCREMENT keeps it increasing and never reused,
+    also after old rows are compacted away.
+    """
+    __tablename__ = "change_log"
+    __table_args__ = {"sqlite_autoincrement": True}
+    
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)  # 'photo', 'video', 'book', 'document', 'character', 'review'
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)  # 'create', 'update', 'delete' (tombstone), 'link' or 'unlink'
+    related_type = Column(String, nullable=True)  # Media (un)linked to a character for 'link'/'unlink'
+    related_id = Column(Integer, nullable=True)
+    changed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class ContentSource(Base):
+    """Extraction state of a book or document file; unchanged files (same size and hash) are skipped"""
+    __tablename__ = "content_sources"
+    
+    media_type = Column(String, primary_key=True)  # 'book' or 'document'
+    media_id = Column(Integer, primary_key=True)
+    file_size = Column(Integer, nullable=False)
+    sha256 = Column(String, nullable=False)
+    page_count = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False)  # 'indexed', 'unsupported' or 'failed'
+    error = Column(Text, nullable=True)
+    indexed_at = Column(DateTime, default=datetime.utcnow)
+
+class ContentChunk(Base):
+    """Piece of extracted page text; searched through the content_fts FTS5 table (see content.py)"""
+    __tablename__ = "content_chunks"
+    __table_args__ = (Index("idx_content_chunks_media", "media_type", "media_id"),)
+    
+    id = Column(Integer, primary_key=True)
+    media_type = Column(String, nullable=False)
+    media_id = Column(Integer, nullable=False)
+    page = Column(Integer, nullable=False)  # 1-based; chapters for EPUB
+    text = Column(Text, nullable=False)
@@ -0,0 +1,263 @@
+import asyncio
+import contextvars
+import functools
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from fastapi import Header, HTTPException
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from database import engine
+
+# Profiling is off unless ADMIN_TOKEN is set. A request is profiled when it
+# sends "X-Profile: 1" with a matching X-Admin-Token, or at random with
+# probability PROFILE_SAMPLE_RATE.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Stored profiles; the oldest is removed when a new one is written
+RING_SIZE = 100
+SAMPLE_INTERVAL_SECONDS = 0.001
+MAX_SQL_STATEMENTS = 1000
+MAX_STACK_DEPTH = 128
+
+class RequestProfile:
+    """Stack samples and SQL statements of one request"""
+
+    def __init__(self, method: str, path: str, query: str):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.query = query
+        self.started_at = datetime.utcnow()
+        self.status: Optional[int] = None
+        self.duration_ms = 0.0
+        self.stacks: Counter = Counter()
+        self.sql: List[dict] = []
+        self.sql_ms = 0.0
+        # Threads currently running this request's endpoint
+        self.threads = set()
+        self._lock = threading.Lock()
+
+    def add_thread(self, ident: int) -> None:
+        with self._lock:
+            self.threads.add(ident)
+
+    def remove_thread(self, ident: int) -> None:
+        with self._lock:
+            self.threads.discard(ident)
+
+    def sample(self, frames: dict) -> None:
+        with self._lock:
+            idents = list(self.threads)
+        for ident in idents:
+            frame = frames.get(ident)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+
+    def add_sql(self, statement: str, duration_ms: float) -> None:
+        with self._lock:
+            self.sql_ms += duration_ms
+            if len(self.sql) < MAX_SQL_STATEMENTS:
+                self.sql.append({"statement": statement, "duration_ms": round(duration_ms, 3)})
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "query": self.query,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration_ms, 3),
+            "samples": sum(self.stacks.values()),
+            "sql_count": len(self.sql),
+            "sql_ms": round(self.sql_ms, 3),
+        }
+
+def _collapse(frame) -> str:
+    """Stack as 'outer;...;inner' frames, the collapsed format read by flamegraph tools"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+_current: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("profile", default=None)
+
+class _Sampler(threading.Thread):
+    def __init__(self, profile: RequestProfile):
+        super().__init__(name=f"profiler-{profile.id[:8]}", daemon=True)
+        self.profile = profile
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL_SECONDS):
+            self.profile.sample(sys._current_frames())
+
+# Endpoints are wrapped so the sampler knows which thread serves the request
+def instrument(endpoint: Callable) -> Callable:
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            profile = _current.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            # The event loop thread also runs other requests meanwhile; their frames are included
+            ident = threading.get_ident()
+            profile.add_thread(ident)
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                profile.remove_thread(ident)
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = _current.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        ident = threading.get_ident()
+        profile.add_thread(ident)
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            profile.remove_thread(ident)
+    return wrapper
+
+class ProfiledRoute(APIRoute):
+    """Route class instrumenting every endpoint (set as app.router.route_class before adding routes)"""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, instrument(endpoint), **kwargs)
+
+# SQL capture; the context variable follows requests into threadpool and write-queue threads
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    if profile is not None and conn.info.get("profile_started"):
+        started = conn.info["profile_started"].pop()
+        profile.add_sql(statement, (time.perf_counter() - started) * 1000)
+
+def token_matches(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """Dependency guarding the admin endpoints"""
+    if not token_matches(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+class ProfilingMiddleware:
+    """ASGI middleware deciding per request whether to profile it"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"], scope.get("query_string", b"").decode())
+        token = _current.set(profile)
+        sampler = _Sampler(profile)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stopped.set()
+            _current.reset(token)
+            profile.duration_ms = (time.perf_counter() - started) * 1000
+            sampler.join()
+            await asyncio.to_thread(store.save, profile)
+
+    @staticmethod
+    def _wanted(scope) -> bool:
+        if not ADMIN_TOKEN or scope["path"].startswith("/api/v1/admin/"):
+            return False
+        headers = dict(scope.get("headers", []))
+        if headers.get(b"x-profile") == b"1":
+            return token_matches(headers.get(b"x-admin-token", b"").decode())
+        # Sub-requests of a batch run inside the profile of the batch request, if any
+        return not scope.get("batch_subrequest") and SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+class ProfileStore:
+    """Profiles as JSON files in a directory, keeping the newest RING_SIZE"""
+
+    def __init__(self, directory: str, size: int = RING_SIZE):
+        self.directory = directory
+        self.size = size
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def _files(self) -> List[str]:
+        """Stored profile files, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def save(self, profile: RequestProfile) -> None:
+        data = {**profile.summary(), "sql": profile.sql, "stacks": dict(profile.stacks)}
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self._path(profile.id) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._path(profile.id))
+            for old_path in self._files()[self.size:]:
+                os.remove(old_path)
+
+    def list(self) -> List[dict]:
+        summaries = []
+        for path in self._files():
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # removed or being replaced meanwhile
+            data.pop("sql")
+            data.pop("stacks")
+            summaries.append(data)
+        return summaries
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        if not profile_id.isalnum():
+            return None
+        try:
+            with open(self._path(profile_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+def collapsed(data: dict) -> str:
+    """Stacks as 'frame;frame;frame count' lines for flamegraph.pl, speedscope or inferno"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(data["stacks"].items()))
+
+store = ProfileStore(PROFILE_DIR)
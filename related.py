@@ -0,0 +1,193 @@
+import logging
+import threading
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy.orm import Session
+
+import crud
+from database import SessionLocal
+from models import character_book, character_photo, character_video
+
+logger = logging.getLogger(__name__)
+
+# Association table and its media column per media type
+LINK_TABLES = {
+    "photo": (character_photo, "photo_id"),
+    "video": (character_video, "video_id"),
+    "book": (character_book, "book_id"),
+}
+
+class CooccurrenceGraph:
+    """Character/media incidence matrix and character co-occurrence counts
+
+    M is a sparse (media x characters) 0/1 matrix built from the association
+    tables, C = M.T @ M counts the media two characters share. New links and
+    the links of deleted characters or media are queued as +1/-1 entries and
+    folded into both matrices with small sparse deltas on the next query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._media_index: Dict[Tuple[str, int], int] = {}
+        self._media_keys: List[Tuple[str, int]] = []
+        self._character_index: Dict[int, int] = {}
+        self._character_ids: List[int] = []
+        # Current links by media row and by character column
+        self._media_links: Dict[int, Set[int]] = {}
+        self._character_links: Dict[int, Set[int]] = {}
+        self._pending: List[Tuple[int, int, int]] = []
+        self._media = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self._cooccurrence = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self._stale = True
+
+    # Changes
+    def add_link(self, character_id: int, media_type: str, media_id: int) -> None:
+        with self._lock:
+            if self._stale:
+                return  # picked up by the rebuild
+            row = self._media_row(media_type, media_id)
+            column = self._character_column(character_id)
+            if column not in self._media_links.setdefault(row, set()):
+                self._media_links[row].add(column)
+                self._character_links.setdefault(column, set()).add(row)
+                self._pending.append((row, column, 1))
+
+    def remove_media(self, media_type: str, media_id: int) -> None:
+        with self._lock:
+            row = self._media_index.get((media_type, media_id))
+            if self._stale or row is None:
+                return
+            for column in self._media_links.pop(row, ()):
+                self._character_links[column].discard(row)
+                self._pending.append((row, column, -1))
+
+    def remove_character(self, character_id: int) -> None:
+        with self._lock:
+            column = self._character_index.get(character_id)
+            if self._stale or column is None:
+                return
+            for row in self._character_links.pop(column, ()):
+                self._media_links[row].discard(column)
+                self._pending.append((row, column, -1))
+
+    def _media_row(self, media_type: str, media_id: int) -> int:
+        key = (media_type, media_id)
+        if key not in self._media_index:
+            self._media_index[key] = len(self._media_keys)
+            self._media_keys.append(key)
+        return self._media_index[key]
+
+    def _character_column(self, character_id: int) -> int:
+        if character_id not in self._character_index:
+            self._character_index[character_id] = len(self._character_ids)
+            self._character_ids.append(character_id)
+        return self._character_index[character_id]
+
+    # Refresh
+    def warm(self) -> None:
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        if self._stale:
+            self._rebuild()
+        elif self._pending:
+            self._apply_pending()
+
+    def _rebuild(self) -> None:
+        db = SessionLocal()
+        try:
+            self._media_index, self._media_keys = {}, []
+            self._character_index, self._character_ids = {}, []
+            rows, columns = [], []
+            for media_type, (table, column) in LINK_TABLES.items():
+                for character_id, media_id in db.query(table.c.character_id, table.c[column]):
+                    rows.append(self._media_row(media_type, media_id))
+                    columns.append(self._character_column(character_id))
+        finally:
+            db.close()
+        shape = (len(self._media_keys), len(self._character_ids))
+        self._media = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=shape
+        )
+        self._media.data[:] = 1  # duplicates are summed by the constructor
+        self._cooccurrence = (self._media.T @ self._media).tocsr()
+        self._media_links, self._character_links = {}, {}
+        for row, column in zip(rows, columns):
+            self._media_links.setdefault(row, set()).add(column)
+            self._character_links.setdefault(column, set()).add(row)
+        self._pending = []
+        self._stale = False
+        logger.info("Built co-occurrence graph: %d media, %d characters, %d links", *shape, self._media.nnz)
+
+    def _apply_pending(self) -> None:
+        rows, columns, signs = zip(*self._pending)
+        self._pending = []
+        shape = (len(self._media_keys), len(self._character_ids))
+        old = self._media
+        old.resize(shape)
+        self._cooccurrence.resize((shape[1], shape[1]))
+        # An add and a delete of the same link sum to 0
+        delta = sparse.csr_matrix((np.array(signs, dtype=np.int32), (rows, columns)), shape=shape)
+        delta.eliminate_zeros()
+        # (M + D).T @ (M + D) = M.T @ M + M.T @ D + D.T @ M + D.T @ D
+        cross = old.T @ delta
+        self._cooccurrence = (self._cooccurrence + cross + cross.T + delta.T @ delta).tocsr()
+        self._cooccurrence.eliminate_zeros()
+        self._media = (old + delta).tocsr()
+        self._media.eliminate_zeros()
+
+    # Queries
+    def related_characters(self, character_id: int, limit: int = 10) -> List[Tuple[int, int]]:
+        """(character_id, shared media count), most shared first"""
+        with self._lock:
+            self._refresh()
+            column = self._character_index.get(character_id)
+            if column is None:
+                return []
+            row = self._cooccurrence.getrow(column)
+            scores, others = row.data, row.indices
+            keep = (others != column) & (scores > 0)
+            return self._top([self._character_ids[i] for i in others[keep]], scores[keep], limit)
+
+    def related_media(self, media_type: str, media_id: int, limit: int = 10) -> List[Tuple[Tuple[str, int], int]]:
+        """((media_type, media_id), shared character count), most shared first"""
+        with self._lock:
+            self._refresh()
+            row = self._media_index.get((media_type, media_id))
+            if row is None:
+                return []
+            scores = (self._media @ self._media.getrow(row).T).tocoo()
+            keep = (scores.row != row) & (scores.data > 0)
+            return self._top([self._media_keys[i] for i in scores.row[keep]], scores.data[keep], limit)
+
+    @staticmethod
+    def _top(keys: list, scores: np.ndarray, limit: int) -> list:
+        candidates = np.arange(len(keys))
+        if len(keys) > limit:
+            # Everything scoring at least the limit-th best, so ties are broken by key
+            threshold = -np.partition(-scores, limit - 1)[limit - 1]
+            candidates = np.flatnonzero(scores >= threshold)
+        best = sorted(candidates, key=lambda i: (-scores[i], keys[i]))[:limit]
+        return [(keys[i], int(scores[i])) for i in best]
+
+graph = CooccurrenceGraph()
+
+def _on_character_change(db: Session, event: str, obj) -> None:
+    if event == "link":
+        graph.add_link(*obj)
+    elif event == "delete":
+        # Deletes cascade to the association tables
+        graph.remove_character(obj.id)
+
+def _media_listener(media_type: str):
+    def listener(db: Session, event: str, obj) -> None:
+        if event == "delete":
+            graph.remove_media(media_type, obj.id)
+    return listener
+
+crud.character.add_listener(_on_character_change)
+for _media_type in LINK_TABLES:
+    getattr(crud, _media_type).add_listener(_media_listener(_media_type))
@@ -0,0 +1,159 @@
+"""Replay captured requests (see capture.py) against a running instance
+
+    python replay.py captures/requests.jsonl --base-url http://localhost:8000 --speed 2 --concurrency 16
+
+Requests are sent in their recorded order, spaced like the recording divided
+by --speed (--speed 0 sends them as fast as the concurrency allows). The report
+compares latency percentiles and response statuses with the recorded run;
+--compare-body also compares the response body hashes. Replay against a copy
+of the database as it was when the capture started, since writes are replayed too.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+# Mismatches listed in the report
+MAX_LISTED_MISMATCHES = 20
+
+def load(paths: Iterable[str]) -> List[dict]:
+    """Records of all files (rotated ones included) in recorded order"""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda record: (record["ts"], record.get("seq", 0)))
+
+def send(base_url: str, record: dict, timeout: float) -> dict:
+    """Send one record; returns status, response hash and latency"""
+    url = base_url.rstrip("/") + record["path"]
+    if record.get("query"):
+        url += "?" + record["query"]
+    if "body_base64" in record:
+        data = base64.b64decode(record["body_base64"])
+    elif "body" in record:
+        data = record["body"].encode("utf-8")
+    else:
+        data = None
+    request = urllib.request.Request(url, data=data, method=record["method"])
+    if record.get("content_type"):
+        request.add_header("Content-Type", record["content_type"])
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    except (urllib.error.URLError, OSError) as e:
+        return {"status": None, "error": str(e), "latency_ms": (time.perf_counter() - started) * 1000}
+    return {
+        "status": status,
+        "sha256": hashlib.sha256(body).hexdigest(),
+        "latency_ms": (time.perf_counter() - started) * 1000,
+    }
+
+def replay(records: List[dict], base_url: str, speed: float, concurrency: int,
+           timeout: float) -> Tuple[List[Optional[dict]], float]:
+    """Send records on the recorded schedule with at most `concurrency` in flight
+
+    Returns the result of each record (None for truncated ones, which are not
+    sent) and how far behind the schedule the replay fell, in milliseconds.
+    """
+    results: List[Optional[dict]] = [None] * len(records)
+    slots = threading.BoundedSemaphore(concurrency)
+    lag_ms = 0.0
+
+    def run(index: int) -> None:
+        try:
+            results[index] = send(base_url, records[index], timeout)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.monotonic()
+        first_ts = records[0]["ts"] if records else 0.0
+        for index, record in enumerate(records):
+            if record.get("body_truncated"):
+                continue
+            if speed > 0:
+                due = started + (record["ts"] - first_ts) / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            if speed > 0:
+                # Falls behind once all slots stay busy
+                lag_ms = max(lag_ms, (time.monotonic() - due) * 1000)
+            pool.submit(run, index)
+    return results, lag_ms
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(values)
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 3)
+
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": round(ordered[-1], 3)}
+
+def report(records: List[dict], results: List[Optional[dict]], compare_body: bool, elapsed: float,
+           lag_ms: float) -> dict:
+    mismatches = []
+    errors = 0
+    for record, result in zip(records, results):
+        if result is None:
+            continue
+        if result["status"] is None:
+            errors += 1
+            mismatches.append({"method": record["method"], "path": record["path"], "error": result["error"]})
+            continue
+        problems = {}
+        if result["status"] != record["status"]:
+            problems["status"] = [record["status"], result["status"]]
+        if compare_body and result["sha256"] != record.get("response_sha256"):
+            problems["body"] = "differs"
+        if problems:
+            mismatches.append({"method": record["method"], "path": record["path"], **problems})
+
+    sent = [result for result in results if result is not None]
+    return {
+        "requests": len(sent),
+        "skipped_truncated": len(records) - len(sent),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rate_per_s": round(len(sent) / elapsed, 1) if elapsed else 0.0,
+        "max_schedule_lag_ms": round(lag_ms, 3),
+        "recorded_latency_ms": percentiles([r["duration_ms"] for r, result in zip(records, results) if result]),
+        "replayed_latency_ms": percentiles([result["latency_ms"] for result in sent if result["status"] is not None]),
+        "mismatches": len(mismatches),
+        "mismatch_examples": mismatches[:MAX_LISTED_MISMATCHES],
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay captured requests and compare with the recorded run")
+    parser.add_argument("files", nargs="+", help="capture files, e.g. captures/requests.jsonl.1 captures/requests.jsonl")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of the recorded rate; 0 = no pacing")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at most")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per request, in seconds")
+    parser.add_argument("--compare-body", action="store_true", help="also compare response body hashes")
+    args = parser.parse_args(argv)
+
+    records = load(args.files)
+    started = time.monotonic()
+    results, lag_ms = replay(records, args.base_url, args.speed, max(1, args.concurrency), args.timeout)
+    summary = report(records, results, args.compare_body, time.monotonic() - started, lag_ms)
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["mismatches"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
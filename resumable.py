@@ -0,0 +1,215 @@
+import os
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import schemas
+import storage
+import writer
+from models import CompletedUpload, UploadChunk, UploadSession
+
+# Part files live next to the blob store so completing an upload is a rename
+SESSION_DIR = os.path.join(storage.UPLOAD_DIR, ".sessions")
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_FILE_SIZE = 20 * 1024 * 1024 * 1024
+# Sessions without activity for this long are discarded by expire_sessions()
+SESSION_TTL = timedelta(hours=24)
+
+os.makedirs(SESSION_DIR, exist_ok=True)
+
+# Chunk writes in flight per session. Completing or discarding a session closes
+# it: new chunk writes are refused and the ones in flight are waited for, so
+# nothing is written into a part file once it is stored or removed.
+_writes = threading.Condition()
+_writes_in_flight = Counter()
+_closed = set()
+
+def part_path(session_id: str) -> str:
+    return os.path.join(SESSION_DIR, f"{session_id}.part")
+
+def create_session(db: Session, upload: schemas.UploadSessionCreate) -> UploadSession:
+    session = UploadSession(
+        id=uuid.uuid4().hex,
+        media_type=upload.media_type.value,
+        title=upload.title,
+        description=upload.description,
+        filename=os.path.basename(upload.filename),
+        content_type=upload.content_type or storage.guess_content_type(upload.filename),
+        total_size=upload.total_size,
+        expires_at=datetime.utcnow() + SESSION_TTL
+    )
+    # Preallocate the full size (sparse on most filesystems); chunks are written in place
+    with open(part_path(session.id), "wb") as f:
+        f.truncate(upload.total_size)
+
+    def add(wdb: Session) -> UploadSession:
+        wdb.add(session)
+        wdb.flush()
+        return session
+    try:
+        return writer.queue.execute(db, add)
+    except Exception:
+        _remove_part(session.id)
+        raise
+
+def get_session(db: Session, session_id: str) -> Optional[UploadSession]:
+    session = db.get(UploadSession, session_id)
+    if session is None or session.expires_at < datetime.utcnow():
+        return None
+    return session
+
+def is_completed(db: Session, session_id: str) -> bool:
+    return db.get(CompletedUpload, session_id) is not None
+
+def write_chunk(db: Session, session: UploadSession, offset: int, data: bytes) -> bool:
+    """Write one chunk at its offset; chunks of one session may be written concurrently
+
+    Returns False when the session was completed or discarded meanwhile.
+    """
+    session_id = session.id
+    with _writes:
+        if session_id in _closed:
+            return False
+        _writes_in_flight[session_id] += 1
+    try:
+        try:
+            fd = os.open(part_path(session_id), os.O_WRONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            written = 0
+            while written < len(data):
+                written += os.pwrite(fd, data[written:], offset + written)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        def record(wdb: Session) -> bool:
+            upload = wdb.get(UploadSession, session_id)
+            if upload is None:
+                return False
+            stmt = sqlite_insert(UploadChunk).values(session_id=session_id, offset=offset, length=len(data))
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[UploadChunk.session_id, UploadChunk.offset],
+                set_={"length": stmt.excluded.length}
+            )
+            wdb.execute(stmt)
+            upload.expires_at = datetime.utcnow() + SESSION_TTL
+            return True
+        recorded = writer.queue.execute(db, record, attach=False)
+    finally:
+        with _writes:
+            _writes_in_flight[session_id] -= 1
+            if not _writes_in_flight[session_id]:
+                del _writes_in_flight[session_id]
+                _writes.notify_all()
+    if recorded:
+        db.expire(session, ["expires_at"])
+    return recorded
+
+def close_writes(session_id: str) -> None:
+    """Refuse new chunk writes to the session and wait for those in flight"""
+    with _writes:
+        _closed.add(session_id)
+        _writes.wait_for(lambda: not _writes_in_flight[session_id])
+
+def open_writes(session_id: str) -> None:
+    with _writes:
+        _closed.discard(session_id)
+
+def missing_ranges(db: Session, session: UploadSession) -> Tuple[int, List[List[int]]]:
+    """Received byte count and the [start, end) ranges not covered by any chunk"""
+    chunks = db.query(UploadChunk.offset, UploadChunk.length).filter(
+        UploadChunk.session_id == session.id
+    ).order_by(UploadChunk.offset).all()
+    missing = []
+    received = 0
+    position = 0
+    for offset, length in chunks:
+        if offset > position:
+            missing.append([position, offset])
+        end = offset + length
+        if end > position:
+            received += end - max(offset, position)
+            position = end
+    if position < session.total_size:
+        missing.append([position, session.total_size])
+    return received, missing
+
+def progress(db: Session, session: UploadSession) -> dict:
+    received, missing = missing_ranges(db, session)
+    return {
+        "id": session.id,
+        "media_type": session.media_type,
+        "title": session.title,
+        "filename": session.filename,
+        "total_size": session.total_size,
+        "received_size": received,
+        "missing": missing,
+        "expires_at": session.expires_at,
+    }
+
+def finish(db: Session, session: UploadSession, digest: str) -> Optional[Tuple[str, int]]:
+    """Move the assembled file into the blob store and replace the session by a tombstone
+
+    Runs as a write queue operation with writes to the session closed (see
+    close_writes), with the SHA-256 of the part file computed beforehand.
+    Nothing is committed here: the queue commits together with the media
+    row. Returns None when a concurrent request already completed
+    or discarded the session.
+    """
+    session_id, extension = session.id, os.path.splitext(session.filename)[1]
+    # Deleting the session row claims it; a second completion runs later in the
+    # queue and finds nothing to delete
+    if not _delete_rows(db, session_id):
+        return None
+    db.add(CompletedUpload(id=session_id))
+    return storage.blobs.store_file(db, part_path(session_id), extension, digest)
+
+def discard(db: Session, session: UploadSession) -> None:
+    session_id = session.id
+    close_writes(session_id)
+    try:
+        writer.queue.execute(db, lambda wdb: _delete_rows(wdb, session_id), attach=False)
+        _remove_part(session_id)
+    finally:
+        open_writes(session_id)
+
+def expire_sessions(db: Session) -> int:
+    """Remove sessions past their expiry together with their part files, and old tombstones"""
+    now = datetime.utcnow()
+    expired = [row.id for row in db.query(UploadSession.id).filter(UploadSession.expires_at < now)]
+    removed = 0
+    for session_id in expired:
+        close_writes(session_id)
+        try:
+            if writer.queue.execute(db, lambda wdb: _delete_expired(wdb, session_id, now), attach=False):
+                _remove_part(session_id)
+                removed += 1
+        finally:
+            open_writes(session_id)
+    writer.queue.execute(db, lambda wdb: wdb.query(CompletedUpload).filter(
+        CompletedUpload.completed_at < now - SESSION_TTL
+    ).delete(synchronize_session=False), attach=False)
+    return removed
+
+def _delete_expired(db: Session, session_id: str, now: datetime) -> int:
+    # A chunk written since the expiry query extends the session
+    upload = db.get(UploadSession, session_id)
+    if upload is None or upload.expires_at >= now:
+        return 0
+    return _delete_rows(db, session_id)
+
+def _delete_rows(db: Session, session_id: str) -> int:
+    deleted = db.query(UploadSession).filter(UploadSession.id == session_id).delete(synchronize_session=False)
+    db.query(UploadChunk).filter(UploadChunk.session_id == session_id).delete(synchronize_session=False)
+    return deleted
+
+def _remove_part(session_id: str) -> None:
+    if os.path.exists(part_path(session_id)):
+        os.remove(part_path(session_id))
@@ -1,6 +1,6 @@
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import datetime
-from typing import Optional, List
+from typing import Any, Optional, List, Union
 from enum import Enum
 
 class MediaType(str, Enum):
@@ -9,6 +9,17 @@ class MediaType(str, Enum):
     BOOK = "book"
     DOCUMENT = "document"
 
+class MediaCollection(str, Enum):
+    """URL segment of the media types that can be linked to characters"""
+    PHOTOS = "photos"
+    VIDEOS = "videos"
+    BOOKS = "books"
+
+class RankingMetric(str, Enum):
+    AVG = "avg"
+    COUNT = "count"
+    BAYESIAN = "bayesian"
+
 # Base schemas
 class PhotoBase(BaseModel):
     title: str
@@ -134,6 +145,40 @@ class ReviewResponse(ReviewBase):
     created_at: datetime
     model_config = ConfigDict(from_attributes=True)
 
+# Multi-get response schemas: items follow the requested order, None for ids not found
+class PhotoManyResponse(BaseModel):
+    items: List[Optional[PhotoResponse]]
+    missing: List[int]
+
+class VideoManyResponse(BaseModel):
+    items: List[Optional[VideoResponse]]
+    missing: List[int]
+
+class BookManyResponse(BaseModel):
+    items: List[Optional[BookResponse]]
+    missing: List[int]
+
+class UserDocumentManyResponse(BaseModel):
+    items: List[Optional[UserDocumentResponse]]
+    missing: List[int]
+
+class CharacterManyResponse(BaseModel):
+    items: List[Optional[CharacterResponse]]
+    missing: List[int]
+
+class ReviewManyResponse(BaseModel):
+    items: List[Optional[ReviewResponse]]
+    missing: List[int]
+
+class MediaItem(BaseModel):
+    media_type: MediaType
+    id: int
+    item: Optional[Union[PhotoResponse, VideoResponse, BookResponse, UserDocumentResponse]] = None
+
+class MediaManyResponse(BaseModel):
+    items: List[MediaItem]
+    missing: List[str]  # "type:id" references not found
+
 # Simplified response schemas for relationships
 class PhotoSimpleResponse(BaseModel):
     id: int
@@ -161,8 +206,124 @@ class SearchQuery(BaseModel):
     offset: int = 0
 
 class MediaFilter(BaseModel):
+    """Query filters for list endpoints; pagination stays in skip/limit"""
     media_type: Optional[MediaType] = None
+    file_type: Optional[str] = None
+    author: Optional[str] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
     min_rating: Optional[int] = None
     max_rating: Optional[int] = None
-    limit: int = 20
-    offset: int = 0
\ No newline at end of file
+    has_character: Optional[bool] = None
+    # Whitelisted sort key, prefix with "-" for descending order (e.g. "-created_at")
+    sort: Optional[str] = None
+
+# Ranking schemas
+class RankingEntry(BaseModel):
+    media_type: MediaType
+    media_id: int
+    review_count: int
+    average_rating: float
+    score: float
+
+class RankingResponse(BaseModel):
+    media_type: MediaType
+    window_days: int
+    by: RankingMetric
+    results: List[RankingEntry]
+
+
+# Resumable upload schemas
+class UploadSessionCreate(BaseModel):
+    media_type: MediaType
+    title: str
+    description: Optional[str] = None
+    filename: str
+    content_type: Optional[str] = None
+    total_size: int = Field(..., gt=0)
+
+class UploadSessionResponse(BaseModel):
+    id: str
+    media_type: MediaType
+    title: str
+    filename: str
+    total_size: int
+    received_size: int
+    # Byte ranges [start, end) still to be uploaded
+    missing: List[List[int]]
+    expires_at: datetime
+
+
+class SimilarPhotoResponse(BaseModel):
+    photo: PhotoResponse
+    distance: int
+
+
+class AutocompleteItem(BaseModel):
+    type: str
+    id: Optional[int] = None  # None for book authors
+    label: str
+    popularity: int
+
+
+# Recommendation schemas
+class CharacterSimpleResponse(BaseModel):
+    id: int
+    name: str
+    description: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
+
+class RelatedCharacter(BaseModel):
+    character: CharacterSimpleResponse
+    shared_media: int
+
+class RelatedMedia(BaseModel):
+    media_type: MediaType
+    id: int
+    title: str
+    file_path: str
+    shared_characters: int
+
+
+# Change feed schemas
+class ChangeEntry(BaseModel):
+    cursor: int
+    entity: str
+    id: int
+    op: str  # 'create', 'update', 'delete', 'link' or 'unlink'
+    related_type: Optional[str] = None
+    related_id: Optional[int] = None
+    changed_at: datetime
+
+class ChangeFeedResponse(BaseModel):
+    changes: List[ChangeEntry]
+    cursor: int  # Pass as since= on the next request
+    has_more: bool
+
+
+class ContentSearchHit(BaseModel):
+    media_type: MediaType
+    id: int
+    title: str
+    page: int
+    snippet: str  # Matched words wrapped in <b></b>
+    score: float
+
+
+# Batch request schemas
+class BatchRequestItem(BaseModel):
+    method: str = Field(..., pattern="^(GET|POST|PUT|DELETE)$")
+    path: str = Field(..., pattern="^/api/", description="Route path with query string, e.g. /api/v1/reviews/?limit=5")
+    body: Optional[Any] = None
+
+class BatchRequest(BaseModel):
+    requests: List[BatchRequestItem] = Field(..., min_length=1)
+
+class BatchResponseItem(BaseModel):
+    status: int
+    body: Optional[Any] = None
+
+class BatchResponse(BaseModel):
+    responses: List[BatchResponseItem]
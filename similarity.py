@@ -0,0 +1,272 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from sqlalchemy.orm import Session
+
+import crud
+import writer
+from database import SessionLocal
+from models import Photo, PhotoHash
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+# pHash works on the low frequencies of a 32x32 DCT
+PHASH_IMAGE_SIZE = 32
+BACKFILL_BATCH_SIZE = 100
+# Background threads fingerprinting new photos
+WORKERS = 2
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+_DCT = _dct_matrix(PHASH_IMAGE_SIZE)
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), "big")
+
+def compute_hashes(image: Image.Image) -> Tuple[int, int]:
+    """64-bit (pHash, dHash) of an image as unsigned integers"""
+    gray = image.convert("L")
+
+    pixels = np.asarray(gray.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term carries overall brightness only, leave it out of the median
+    phash = _bits_to_int(low > np.median(low.ravel()[1:]))
+
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+    return phash, dhash
+
+def hash_file(file_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        with Image.open(file_path) as image:
+            return compute_hashes(image)
+    except (OSError, ValueError) as e:
+        logger.debug("Cannot fingerprint %s: %s", file_path, e)
+        return None
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        # SWAR bit count over uint64 lanes (numpy < 2.0 has no popcount ufunc)
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+class HashIndex:
+    """In-memory photo fingerprints in contiguous arrays, searched by Hamming distance"""
+
+    def __init__(self, capacity: int = 1024):
+        self._lock = threading.RLock()
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._hashes = {
+            "phash": np.zeros(capacity, dtype=np.uint64),
+            "dhash": np.zeros(capacity, dtype=np.uint64),
+        }
+        self._positions = {}
+        self._size = 0
+        # Changes made while load() reads the table, replayed on the loaded arrays
+        self._pending = None
+        self.ready = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, photo_id: int, phash: int, dhash: int) -> None:
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(("add", photo_id, phash, dhash))
+                return
+            position = self._positions.get(photo_id)
+            if position is None:
+                if self._size == len(self._ids):
+                    self._grow()
+                position = self._size
+                self._size += 1
+                self._positions[photo_id] = position
+                self._ids[position] = photo_id
+            self._hashes["phash"][position] = phash & 0xFFFFFFFFFFFFFFFF
+            self._hashes["dhash"][position] = dhash & 0xFFFFFFFFFFFFFFFF
+
+    def remove(self, photo_id: int) -> None:
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(("remove", photo_id))
+                return
+            position = self._positions.pop(photo_id, None)
+            if position is None:
+                return
+            # Move the last entry into the hole to keep the arrays dense
+            last = self._size - 1
+            if position != last:
+                moved_id = int(self._ids[last])
+                self._ids[position] = moved_id
+                for values in self._hashes.values():
+                    values[position] = values[last]
+                self._positions[moved_id] = position
+            self._size = last
+
+    def get(self, photo_id: int, algorithm: str = "phash") -> Optional[int]:
+        with self._lock:
+            position = self._positions.get(photo_id)
+            return None if position is None else int(self._hashes[algorithm][position])
+
+    def search(self, value: int, max_distance: int, limit: int = 20, algorithm: str = "phash",
+               exclude_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        """(photo_id, distance) pairs within max_distance, nearest first"""
+        with self._lock:
+            ids = self._ids[:self._size]
+            distances = _popcount(self._hashes[algorithm][:self._size] ^ np.uint64(value))
+            matches = np.flatnonzero(distances <= max_distance)
+            if exclude_id is not None:
+                matches = matches[ids[matches] != exclude_id]
+            if len(matches) > limit:
+                nearest = np.argpartition(distances[matches], limit - 1)[:limit]
+                matches = matches[nearest]
+            order = np.lexsort((ids[matches], distances[matches]))
+            return [(int(ids[i]), int(distances[i])) for i in matches[order]]
+
+    def load(self, db: Session) -> None:
+        """Replace the arrays with the stored fingerprints; changes made meanwhile are replayed afterwards"""
+        with self._lock:
+            self._pending = []
+        try:
+            rows = db.query(PhotoHash.photo_id, PhotoHash.phash, PhotoHash.dhash).all()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        capacity = max(1024, len(rows))
+        ids = np.zeros(capacity, dtype=np.int64)
+        phashes = np.zeros(capacity, dtype=np.uint64)
+        dhashes = np.zeros(capacity, dtype=np.uint64)
+        if rows:
+            columns = np.array(rows, dtype=np.int64)
+            ids[:len(rows)] = columns[:, 0]
+            phashes[:len(rows)] = columns[:, 1].view(np.uint64)
+            dhashes[:len(rows)] = columns[:, 2].view(np.uint64)
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._ids = ids
+            self._hashes = {"phash": phashes, "dhash": dhashes}
+            self._positions = {int(photo_id): i for i, photo_id in enumerate(ids[:len(rows)])}
+            self._size = len(rows)
+            for method, *args in pending:
+                getattr(self, method)(*args)
+        self.ready = True
+
+    def _grow(self) -> None:
+        capacity = len(self._ids) * 2
+        self._ids = np.resize(self._ids, capacity)
+        self._hashes = {name: np.resize(values, capacity) for name, values in self._hashes.items()}
+
+index = HashIndex()
+
+def fingerprint_photo(db: Session, photo_id: int, file_path: Optional[str]) -> bool:
+    """Hash a photo's file, store the fingerprint through the write queue and add it to the index"""
+    if not file_path or not os.path.isfile(file_path):
+        return False
+    hashes = hash_file(file_path)
+    if hashes is None:
+        return False
+    phash, dhash = hashes
+
+    def store(wdb: Session) -> bool:
+        # The photo may have been deleted while its file was hashed
+        if wdb.get(Photo, photo_id) is None:
+            return False
+        wdb.merge(PhotoHash(photo_id=photo_id, phash=_to_signed(phash), dhash=_to_signed(dhash)))
+        # Added right after the commit on the writing thread, so a later delete removes it again
+        writer.queue.after_commit(lambda: index.add(photo_id, phash, dhash))
+        return True
+    return writer.queue.execute(db, store, attach=False)
+
+class Fingerprinter:
+    """Worker pool hashing new photos off the request thread"""
+
+    def __init__(self, workers: int = WORKERS):
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="photo-hash")
+
+    def stop(self) -> None:
+        """Wait for running work (before the write queue stops) and drop the rest"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, photo_id: int, file_path: Optional[str]) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.submit(self._run, photo_id, file_path)
+
+    @staticmethod
+    def _run(photo_id: int, file_path: Optional[str]) -> None:
+        db = SessionLocal()
+        try:
+            fingerprint_photo(db, photo_id, file_path)
+        except Exception:
+            logger.exception("Fingerprinting photo %d failed", photo_id)
+        finally:
+            db.close()
+
+fingerprinter = Fingerprinter()
+
+def _on_photo_change(db: Session, event: str, photo: Photo) -> None:
+    if event == "create":
+        # Photos created while no worker runs (scripts) are picked up by backfill()
+        fingerprinter.submit(photo.id, photo.file_path)
+    elif event == "delete":
+        index.remove(photo.id)
+
+crud.photo.add_listener(_on_photo_change)
+
+def load_index() -> None:
+    db = SessionLocal()
+    try:
+        index.load(db)
+        logger.info("Loaded %d photo fingerprints", len(index))
+    finally:
+        db.close()
+
+def backfill(db: Session, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Fingerprint existing photos that have none yet"""
+    hashed = 0
+    last_id = 0
+    while True:
+        photos = db.query(Photo).outerjoin(PhotoHash, PhotoHash.photo_id == Photo.id).filter(
+            PhotoHash.photo_id.is_(None), Photo.id > last_id
+        ).order_by(Photo.id).limit(batch_size).all()
+        if not photos:
+            return hashed
+        for photo in photos:
+            last_id = photo.id
+            hashed += fingerprint_photo(db, photo.id, photo.file_path)
+
+if __name__ == "__main__":
+    session = SessionLocal()
+    try:
+        print(f"Fingerprinted {backfill(session)} photos")
+    finally:
+        session.close()
@@ -0,0 +1,152 @@
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from typing import BinaryIO, Optional, Tuple
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import writer
+from database import SessionLocal
+from models import Blob
+
+UPLOAD_DIR = "uploads"
+CHUNK_SIZE = 1024 * 1024
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+def guess_content_type(filename: str) -> str:
+    """Content type from the file name, for uploads that did not send one"""
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+class BlobStorage:
+    """Content-addressed file store: one file per SHA-256 under root/ab/cd/abcd...<ext>
+
+    Media rows keep the blob path in file_path; the blobs table counts how many
+    rows share it. Creating a media row takes a reference (acquire) and deleting
+    it drops one (release), in the same transaction as the row. Blob writes run
+    on the write queue, whose thread also removes unused files after the commit.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, ".tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def blob_path(self, digest: str, extension: str = "") -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + extension.lower())
+
+    @staticmethod
+    def digest_of(file_path: str) -> Optional[str]:
+        """SHA-256 encoded in a blob path, None for files outside the blob layout"""
+        digest = os.path.splitext(os.path.basename(file_path))[0]
+        return digest if _DIGEST_RE.match(digest) else None
+
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def spool(self, stream: BinaryIO) -> Tuple[str, str, int]:
+        """Copy a stream to a temporary file in the store; returns (tmp_path, sha256, size)
+
+        No database access, so the slow part of an upload can run before the
+        write operation; hand the file to store_file() there.
+        """
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, sha.hexdigest(), size
+
+    def store_file(self, db: Session, file_path: str, extension: str = "",
+                   digest: Optional[str] = None) -> Tuple[str, int]:
+        """Move an existing file (same filesystem) into the store without copying it
+
+        Only registers the blob: the media row created with the returned path
+        takes the reference when it is inserted.
+        """
+        digest = digest or self.hash_file(file_path)
+        size = os.path.getsize(file_path)
+        stored = self._adopt(db, file_path, digest, size, extension)
+        if os.path.exists(file_path) and os.path.abspath(file_path) != os.path.abspath(stored):
+            # Identical content was already stored
+            os.remove(file_path)
+        return stored, size
+
+    def _adopt(self, db: Session, src_path: str, digest: str, size: int, extension: str) -> str:
+        # Files are only unlinked by the writer thread between batches (see release),
+        # so an existing blob file cannot disappear before this transaction commits
+        stmt = sqlite_insert(Blob).values(
+            sha256=digest, file_path=self.blob_path(digest, extension), file_size=size, ref_count=0
+        ).on_conflict_do_nothing(index_elements=[Blob.sha256])
+        db.execute(stmt)
+        blob_path = db.query(Blob.file_path).filter(Blob.sha256 == digest).scalar()
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(src_path, blob_path)
+        return blob_path
+
+    def acquire(self, db: Session, file_path: Optional[str]) -> None:
+        """Take a reference for a new media row pointing at file_path
+
+        Paths outside the blob layout are ignored. A blob path given by a client
+        that is not registered yet is registered, so the reference is dropped
+        again, and only once, when the row is deleted.
+        """
+        digest = self.digest_of(file_path) if file_path else None
+        if digest is None:
+            return
+        blob = db.get(Blob, digest)
+        if blob is None:
+            if os.path.normpath(file_path) != self.blob_path(digest, os.path.splitext(file_path)[1]):
+                return
+            size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+            db.add(Blob(sha256=digest, file_path=file_path, file_size=size, ref_count=1))
+        elif blob.file_path == file_path:
+            blob.ref_count += 1
+        db.flush()
+
+    def release(self, db: Session, file_path: Optional[str]) -> None:
+        """Drop the reference of a deleted media row; the last one removes the file after the commit"""
+        digest = self.digest_of(file_path) if file_path else None
+        if digest is None:
+            return
+        blob = db.get(Blob, digest)
+        if blob is None or blob.file_path != file_path:
+            return
+        blob.ref_count -= 1
+        if blob.ref_count <= 0:
+            db.delete(blob)
+            db.flush()
+            # A rollback keeps the file. An upload later in the same batch may have
+            # adopted the content again, so the hook checks the committed state;
+            # nothing else is written between the commit and the hook.
+            blob_path = blob.file_path
+            writer.queue.after_commit(lambda: self._remove_unused(digest, blob_path))
+
+    @staticmethod
+    def _remove_unused(digest: str, file_path: str) -> None:
+        db = SessionLocal()
+        try:
+            if db.get(Blob, digest) is not None:
+                return
+        finally:
+            db.close()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+blobs = BlobStorage(UPLOAD_DIR)
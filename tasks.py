@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Callable, List, Tuple
+
+import content
+import crud
+import maintenance
+import resumable
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Registered periodic jobs: (interval in seconds, function)
+_jobs: List[Tuple[float, Callable[[], None]]] = []
+_running: List[asyncio.Task] = []
+
+def periodic(interval_seconds: float):
+    """Register a blocking function to be run every interval_seconds in a worker thread"""
+    def decorator(func: Callable[[], None]) -> Callable[[], None]:
+        _jobs.append((interval_seconds, func))
+        return func
+    return decorator
+
+async def _run_forever(interval_seconds: float, func: Callable[[], None]):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(func)
+        except Exception:
+            logger.exception("Background job %s failed", func.__name__)
+
+def start():
+    """Start all registered jobs on the running event loop (called on app startup)"""
+    for interval_seconds, func in _jobs:
+        _running.append(asyncio.create_task(_run_forever(interval_seconds, func)))
+
+async def stop():
+    for task in _running:
+        task.cancel()
+    await asyncio.gather(*_running, return_exceptions=True)
+    _running.clear()
+
+# Jobs
+@periodic(6 * 60 * 60)
+def compact_review_rollups():
+    db = SessionLocal()
+    try:
+        merged = crud.review_rollup.compact(db)
+        logger.info("Compacted %d review rollup buckets", merged)
+    finally:
+        db.close()
+
+@periodic(60 * 60)
+def compact_orphans():
+    db = SessionLocal()
+    try:
+        removed = maintenance.compact_orphans(db)
+        logger.info("Removed orphaned rows: %s", removed)
+    finally:
+        db.close()
+
+@periodic(24 * 60 * 60)
+def compact_change_log():
+    db = SessionLocal()
+    try:
+        removed = crud.change_log.compact(db)
+        logger.info("Removed %d expired change log entries", removed)
+    finally:
+        db.close()
+
+@periodic(15 * 60)
+def expire_upload_sessions():
+    db = SessionLocal()
+    try:
+        expired = resumable.expire_sessions(db)
+        if expired:
+            logger.info("Removed %d expired upload sessions", expired)
+    finally:
+        db.close()
+
+@periodic(60 * 60)
+def index_content():
+    queued = content.queue_stale_files()
+    if queued:
+        logger.info("Queued %d books/documents for content extraction", queued)
@@ -0,0 +1,288 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from queue import Empty, SimpleQueue
+from typing import Any, Callable, List, Optional
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# A batch is committed once it holds this many operations, or once its oldest
+# operation has waited MAX_DELAY_SECONDS, whichever comes first
+MAX_BATCH_SIZE = 64
+MAX_DELAY_SECONDS = 0.002
+# Recent batches kept for the metrics percentiles
+METRICS_WINDOW = 1024
+# How often a waiting caller checks that the writer thread is still alive
+WAIT_CHECK_SECONDS = 1.0
+
+Operation = Callable[[Session], Any]
+Callback = Callable[[Session, Any], None]
+
+class _Job:
+    __slots__ = ("operation", "on_commit", "attach", "context", "enqueued_at", "result", "error", "callbacks",
+                 "hooks", "done")
+
+    def __init__(self, operation: Operation, on_commit: Optional[Callback], attach: bool):
+        self.operation = operation
+        self.on_commit = on_commit
+        self.attach = attach
+        # The operation runs in the caller's context (e.g. request profiling state)
+        self.context = contextvars.copy_context()
+        self.enqueued_at = time.monotonic()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        # (callback, result, attach) of this job and of write operations nested in it
+        self.callbacks: List[tuple] = []
+        # after_commit() functions, run on the writing thread once committed
+        self.hooks: List[Callable[[], None]] = []
+        self.done = threading.Event()
+
+class WriteQueue:
+    """Single writer thread that group-commits the write operations of all requests
+
+    Each operation runs in its own savepoint inside a shared BEGIN IMMEDIATE
+    transaction, so one failing operation is rolled back alone and its caller
+    gets the exception while the rest of the batch commits with one fsync.
+    Results are detached after the commit and merged into the caller's session.
+    """
+
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_delay: float = MAX_DELAY_SECONDS):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: SimpleQueue = SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        # Guards _thread so no job is enqueued behind the stop sentinel
+        self._lifecycle_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = deque(maxlen=METRICS_WINDOW)
+        self._commit_ms = deque(maxlen=METRICS_WINDOW)
+        self._wait_ms = deque(maxlen=METRICS_WINDOW)
+        self._totals = {"batches": 0, "operations": 0, "failed_operations": 0, "failed_batches": 0}
+
+    # Lifecycle
+    def start(self) -> None:
+        with self._lifecycle_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        """Commit what is queued and stop the writer thread
+
+        Writes issued afterwards commit inline in the caller's session.
+        """
+        with self._lifecycle_lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join()
+        # Nothing can be enqueued behind the sentinel, but never leave a caller waiting
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Empty:
+                break
+            if job is not None:
+                self._fail(job, RuntimeError("Write queue stopped"))
+
+    # Submitting
+    def execute(self, db: Session, operation: Operation, on_commit: Optional[Callback] = None,
+                attach: bool = True) -> Any:
+        """Run operation(session) in the next group commit and return its result
+
+        on_commit(db, result) is called in the caller's thread once the write is
+        committed, unless the result is None. A resulting row is merged into db
+        unless attach is False (deleted rows). Operations must not commit
+        themselves. A write issued from inside another operation joins that
+        operation's transaction. Without a running writer thread (scripts),
+        the operation commits on its own in db.
+        """
+        job = getattr(self._local, "job", None)
+        if job is not None:
+            result = operation(self._local.session)
+            if on_commit is not None and result is not None:
+                job.callbacks.append((on_commit, result, attach))
+            return result
+
+        job = _Job(operation, on_commit, attach)
+        with self._lifecycle_lock:
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(job)
+        if thread is None:
+            self._run_inline(db, job)
+        else:
+            while not job.done.wait(WAIT_CHECK_SECONDS):
+                if not thread.is_alive() and not job.done.is_set():
+                    self._fail(job, RuntimeError("Write queue thread exited"))
+        if job.error is not None:
+            raise job.error
+        # Rows written by the writer session become instances of the caller's session
+        result = self._attach(db, job.result) if job.attach else job.result
+        for callback, value, attach in job.callbacks:
+            if value is job.result:
+                value = result
+            elif attach:
+                value = self._attach(db, value)
+            callback(db, value)
+        return result
+
+    def after_commit(self, hook: Callable[[], None]) -> None:
+        """Run hook() on the writing thread right after the current operation commits
+
+        Nothing else is written in between, which makes it the place for file
+        cleanup that must not race with other writes. Skipped on rollback.
+        """
+        job = getattr(self._local, "job", None)
+        if job is None:
+            raise RuntimeError("after_commit() must be called from a write operation")
+        job.hooks.append(hook)
+
+    @staticmethod
+    def _run_hooks(job: _Job) -> None:
+        for hook in job.hooks:
+            try:
+                hook()
+            except Exception:
+                logger.exception("After-commit hook failed")
+
+    @staticmethod
+    def _fail(job: _Job, error: BaseException) -> None:
+        if not job.done.is_set():
+            job.error = error
+            job.done.set()
+
+    @staticmethod
+    def _attach(db: Session, value: Any) -> Any:
+        state = inspect(value, raiseerr=False)
+        if state is not None and state.detached and state.key is not None:
+            return db.merge(value, load=False)
+        return value
+
+    def _run_inline(self, db: Session, job: _Job) -> None:
+        self._local.job, self._local.session = job, db
+        try:
+            job.result = job.operation(db)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            job.error = e
+            return
+        finally:
+            self._local.job = self._local.session = None
+        self._run_hooks(job)
+        if job.on_commit is not None and job.result is not None:
+            job.callbacks.insert(0, (job.on_commit, job.result, job.attach))
+
+    # Writer thread
+    def _run(self) -> None:
+        db = SessionLocal(expire_on_commit=False)
+        self._local.session = db
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+                if batch:
+                    self._commit(db, batch)
+        finally:
+            db.close()
+
+    def _collect(self) -> Optional[List[_Job]]:
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.enqueued_at + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                job = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                break
+            if job is None:
+                # Commit this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _commit(self, db: Session, batch: List[_Job]) -> None:
+        started = time.monotonic()
+        failed_batch = False
+        try:
+            # Take the write lock up front instead of upgrading from a read lock,
+            # and open the transaction the savepoints below are nested in
+            db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            for job in batch:
+                self._local.job = job
+                try:
+                    with db.begin_nested():
+                        job.result = job.context.run(job.operation, db)
+                except Exception as e:
+                    job.error = e
+                finally:
+                    self._local.job = None
+            db.commit()
+        except Exception as e:
+            logger.exception("Group commit of %d operations failed", len(batch))
+            db.rollback()
+            failed_batch = True
+            for job in batch:
+                if job.error is None:
+                    job.error = e
+        finally:
+            db.expunge_all()
+
+        committed = time.monotonic()
+        for job in batch:
+            if job.error is None:
+                self._run_hooks(job)
+                if job.on_commit is not None and job.result is not None:
+                    job.callbacks.insert(0, (job.on_commit, job.result, job.attach))
+            job.done.set()
+        self._record(batch, started, committed, failed_batch)
+
+    # Metrics
+    def _record(self, batch: List[_Job], started: float, committed: float, failed_batch: bool) -> None:
+        with self._stats_lock:
+            self._batch_sizes.append(len(batch))
+            self._commit_ms.append((committed - started) * 1000)
+            self._wait_ms.extend((started - job.enqueued_at) * 1000 for job in batch)
+            self._totals["batches"] += 1
+            self._totals["operations"] += len(batch)
+            self._totals["failed_operations"] += sum(job.error is not None for job in batch)
+            self._totals["failed_batches"] += failed_batch
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            return {
+                "running": self._thread is not None,
+                "queue_depth": self._queue.qsize(),
+                **self._totals,
+                "batch_size": _summary(self._batch_sizes),
+                "commit_ms": _summary(self._commit_ms),
+                "queue_wait_ms": _summary(self._wait_ms),
+            }
+
+def _summary(values) -> dict:
+    """avg/p50/p99/max over the recent window"""
+    if not values:
+        return {"avg": 0.0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(values)
+    return {
+        "avg": round(sum(ordered) / len(ordered), 3),
+        "p50": round(ordered[len(ordered) // 2], 3),
+        "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+queue = WriteQueue()